@@ -0,0 +1,193 @@
+import gzip
+import time
+import logging
+import threading
+from hashlib import sha1
+from collections import OrderedDict
+from logging import Formatter, Filter, StreamHandler
+from StringIO import StringIO
+import scss
+from cssutils.tokenize2 import Tokenizer
+from google.appengine.api import memcache
+import settings
+
+# Compiled CSS is cached in two tiers: a small LRU in each instance and
+# memcache shared by all instances. Entries are keyed by a hash of the raw SCSS
+# and the compile options, so identical sources (example sites, first_run.css,
+# re-saves of unchanged text) never reach the compiler twice. Each entry keeps
+# how long the compile took and, once they're asked for, the css's stats, so
+# they don't depend on whether it was cached and are only worked out once.
+# The LRU is bounded by the total length of the css and logs it holds, and
+# leaves huge sheets to memcache alone.
+
+_lock = threading.Lock()
+_local = OrderedDict() # key -> (entry, size)
+_local_length = 0 # total size of the entries in _local
+_stats = dict(local_hits=0, memcache_hits=0, misses=0)
+
+class ExceptionFilter(Filter):
+    def filter(self, record):
+        if record.getMessage().lower().startswith('exception'):
+            return 0
+        return 1
+
+def _cache_key(raw, compress):
+    key = sha1()
+    key.update(scss.__version__)
+    key.update('compress' if compress else 'pretty')
+    key.update(raw.encode('utf-8'))
+    return 'scss-%s' % key.hexdigest()
+
+def _local_get(key):
+    with _lock:
+        value = _local.pop(key, None)
+        if value is None:
+            return None
+        _local[key] = value # move to the most recently used end
+        return value[0]
+
+def _local_set(key, value):
+    global _local_length
+    size = len(value[0]) + len(value[1])
+    limit = settings.compile_cache['local_length']
+    with _lock:
+        old = _local.pop(key, None)
+        if old is not None:
+            _local_length -= old[1]
+        if size > limit // 10:
+            return
+        _local[key] = (value, size)
+        _local_length += size
+        while _local_length > limit:
+            _local_length -= _local.popitem(last=False)[1][1]
+
+def _count(stat):
+    with _lock:
+        _stats[stat] += 1
+
+def _compile(raw, compress):
+    log = StringIO()
+    handler = StreamHandler(log)
+    handler.addFilter(ExceptionFilter())
+    handler.setFormatter(Formatter('<span class="level">%(levelname)s</span>: <span class="message">%(message)s</span><br />'))
+    scss.log.addHandler(handler)
+    if not compress:
+        raw = '@option compress:no;' + raw
+    try:
+        if settings.compile_cache['incremental']:
+            # Only recompiles the top-level blocks that changed since the last save
+            css = scss.Scss().compile_incremental(raw)
+        else:
+            css = scss.Scss().compile(raw)
+    finally:
+        scss.log.removeHandler(handler)
+        handler.flush()
+    return css, log.getvalue()
+
+def compile_scss(raw, compress=True):
+    '''
+    Compile `raw` SCSS, returning a (css, log) tuple. The log holds the
+    compiler's warnings formatted for display in the editor.
+    '''
+    return _cached_compile(raw, compress, False)[:2]
+
+def compile_scss_with_stats(raw, compress=True):
+    '''
+    Like compile_scss, but returns a (css, log, compile_ms, stats) tuple, where
+    compile_ms is how long compiling took when it wasn't cached (None for
+    entries cached before that was recorded), and stats is what css_stats
+    returns for the css. Both are kept in the cache with the css.
+    '''
+    return _cached_compile(raw, compress, True)
+
+def _cached_compile(raw, compress, with_stats):
+    raw = raw or u''
+    key = _cache_key(raw, compress)
+    result = _local_get(key)
+    found = 'local'
+    if result is not None:
+        _count('local_hits')
+    else:
+        result = memcache.get(key)
+        found = 'memcache'
+        if result is not None:
+            _count('memcache_hits')
+        else:
+            _count('misses')
+            found = None
+            start = time.time()
+            css, log = _compile(raw, compress)
+            result = (css, log, int((time.time() - start) * 1000))
+    # Entries cached before compile_ms or stats were recorded lack them.
+    result = tuple(result) + (None,) * (4 - len(result))
+    if with_stats and result[3] is None:
+        result = result[:3] + (css_stats(result[0]),)
+        found = None
+    if found is None:
+        try:
+            memcache.set(key, result, time=settings.compile_cache['memcache_time'])
+        except Exception:
+            # Values over memcache's size limit are simply not shared.
+            logging.warn('Could not cache compiled CSS for %s', key)
+    if found != 'local':
+        _local_set(key, result)
+    return result
+
+def gzip_bytes(data):
+    '''
+    Gzip `data` reproducibly (no timestamp in the header).
+    '''
+    buf = StringIO()
+    zipped = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+    zipped.write(data)
+    zipped.close()
+    return buf.getvalue()
+
+def gunzip_bytes(data):
+    return gzip.GzipFile(fileobj=StringIO(data), mode='rb').read()
+
+# At-rules that only group other rules, which are counted instead
+_grouping_rules = set(['@media', '@supports', '@document', '@-moz-document'])
+
+def count_rules(css):
+    '''
+    Counts the rules with a block in `css` (style rules, @font-face, @page,
+    each keyframe...), but not the blocks that group them, like @media.
+    '''
+    count = 0
+    at_keyword = None # of the rule being read, if it's an at-rule
+    starting = True # at the start of a rule
+    for name, value, line, col in Tokenizer(doComments=False).tokenize(css):
+        if name in ('S', 'CDO', 'CDC'):
+            continue
+        if name == 'CHAR' and value in '{};':
+            if value == '{' and at_keyword not in _grouping_rules:
+                count += 1
+            at_keyword = None
+            starting = True
+            continue
+        if starting and value.startswith('@'):
+            at_keyword = value.lower()
+        starting = False
+    return count
+
+def css_stats(css):
+    '''
+    Returns the (size, gzipped size, rule count) of compiled `css`, sizes in
+    bytes of its utf-8 encoding.
+    '''
+    css = css or u''
+    data = css.encode('utf-8')
+    return len(data), len(gzip_bytes(data)), count_rules(css)
+
+def compile_stats():
+    '''
+    Returns the hit/miss counters for this instance.
+    '''
+    with _lock:
+        stats = dict(_stats)
+        stats['local_size'] = len(_local)
+        stats['local_length'] = _local_length
+    lookups = stats['local_hits'] + stats['memcache_hits'] + stats['misses']
+    stats['hit_rate'] = (float(lookups - stats['misses']) / lookups) if lookups else 0.0
+    return stats
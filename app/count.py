@@ -1,16 +1,176 @@
-from datetime import datetime
+import time
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from google.appengine.api import memcache
 from livecount import counter
 from livecount.counter import PeriodType
+from models import ReferrerSketch
+import settings
 
-def count_view(name, period=None, period_types=None, namespace='default', delta=1, batch_size=223):
+# Views counted on the hot path are added up per counter in each instance and
+# written to livecount in one batch; see settings.count_buffer.
+#
+# Referrers are only tracked as the top few (netloc, page key) pairs of each
+# day, in a Space-Saving sketch kept in memcache. Each instance merges its
+# partial counts into it when it flushes, and each day's sketch is saved to
+# the datastore once, when the next day starts (and by the stats cron).
+
+_lock = threading.Lock()
+_buffer = {} # (namespace, batch_size, name, period_type, scope) -> [period, delta]
+_referrers = {} # (netloc, page_key) -> views since the last flush
+_buffered_events = 0
+_last_flush = time.time()
+_persisted_day = None
+
+def count_view(name, period=None, period_types=None, namespace='default', delta=1, batch_size=223, buffered=True):
     if period is None:
         period = datetime.now()
     if period_types is None:
         period_types = [PeriodType.HOUR, PeriodType.DAY, PeriodType.WEEK, PeriodType.MONTH]
-    counter.load_and_increment_counter(name, period=period, period_types=period_types, namespace=namespace, delta=delta, batch_size=batch_size)
-    
+    if not (buffered and settings.count_buffer['enabled']):
+        counter.load_and_increment_counter(name, period=period, period_types=period_types, namespace=namespace, delta=delta, batch_size=batch_size)
+        return
+    global _buffered_events
+    with _lock:
+        for period_type in period_types:
+            key = (namespace, batch_size, name, period_type, PeriodType.find_scope(period_type, period))
+            if key in _buffer:
+                _buffer[key][1] += delta
+            else:
+                _buffer[key] = [period, delta]
+        _buffered_events += 1
+        full = _buffered_events >= settings.count_buffer['max_events'] or time.time() - _last_flush >= settings.count_buffer['max_age']
+    if full:
+        flush_counts()
+
+def count_referrer(netloc, page_key):
+    if not settings.count_buffer['enabled']:
+        _merge_referrers({(netloc, page_key): 1})
+        return
+    with _lock:
+        key = (netloc, page_key)
+        _referrers[key] = _referrers.get(key, 0) + 1
+
+def flush_counts():
+    '''
+    Write the counts buffered in this instance to livecount. Called when the
+    buffer fills up or gets old, and from the warmup and shutdown hooks.
+    Returns the number of counters written.
+    '''
+    global _buffered_events, _last_flush
+    with _lock:
+        pending = _buffer.copy()
+        _buffer.clear()
+        referrers = _referrers.copy()
+        _referrers.clear()
+        _buffered_events = 0
+        _last_flush = time.time()
+    batches = {}
+    for (namespace, batch_size, name, period_type, scope), (period, delta) in pending.items():
+        if delta:
+            batches.setdefault((namespace, batch_size), {})[(name, period_type, period)] = delta
+    written = 0
+    for (namespace, batch_size), deltas in batches.items():
+        try:
+            counter.load_and_increment_counters(deltas, namespace=namespace, batch_size=batch_size)
+            written += len(deltas)
+        except Exception:
+            logging.exception('Failed to flush %d view counters', len(deltas))
+            if settings.count_buffer['keep_on_error']:
+                _restore(namespace, batch_size, deltas)
+    if referrers:
+        _merge_referrers(referrers)
+    return written
+
+def _restore(namespace, batch_size, deltas):
+    with _lock:
+        for (name, period_type, period), delta in deltas.items():
+            key = (namespace, batch_size, name, period_type, PeriodType.find_scope(period_type, period))
+            if key in _buffer:
+                _buffer[key][1] += delta
+            else:
+                _buffer[key] = [period, delta]
+
+def _day(period=None):
+    return PeriodType.find_scope(PeriodType.DAY, period or datetime.now())
+
+def _sketch_key(day):
+    return 'referrer-sketch-%s' % day
+
+def _space_saving_merge(sketch, partial):
+    '''
+    Fold the `partial` counts into `sketch`, a Space-Saving summary of at most
+    settings.referrer_sketch['capacity'] items mapped to [count, error]. Counts
+    overestimate by at most their error, and every item seen more often than
+    total / capacity times is in the sketch.
+    '''
+    capacity = settings.referrer_sketch['capacity']
+    for item, count in sorted(partial.items(), key=lambda i: -i[1]):
+        if item in sketch:
+            sketch[item][0] += count
+        elif len(sketch) < capacity:
+            sketch[item] = [count, 0]
+        else:
+            smallest = min(sketch, key=lambda k: sketch[k][0])
+            floor = sketch.pop(smallest)[0]
+            sketch[item] = [floor + count, floor]
+    return sketch
+
+def _load_sketch(day):
+    stored = ReferrerSketch.get_by_key_name(day)
+    if not stored:
+        return {}
+    return dict(((netloc, page_key), [count, error]) for netloc, page_key, count, error in json.loads(stored.items))
+
+def _merge_referrers(partial):
+    global _persisted_day
+    day = _day()
+    key = _sketch_key(day)
+    client = memcache.Client()
+    for attempt in range(settings.referrer_sketch['cas_retries']):
+        sketch = client.gets(key)
+        if sketch is None:
+            if client.add(key, _space_saving_merge(_load_sketch(day), partial)):
+                break
+        elif client.cas(key, _space_saving_merge(sketch, partial)):
+            break
+    else:
+        logging.warn('Dropped %d referrer counts after %d attempts to merge them', sum(partial.values()), attempt + 1)
+
+    yesterday = _day(datetime.now() - timedelta(days=1))
+    if _persisted_day != yesterday:
+        # Only the first instance to get here each day saves yesterday's sketch.
+        if memcache.add('referrer-sketch-saved-%s' % yesterday, 1, time=2 * 24 * 60 * 60):
+            persist_referrers(yesterday)
+        _persisted_day = yesterday
+
+def persist_referrers(day=None):
+    '''
+    Save a day's referrer sketch (today's by default) from memcache to the datastore.
+    '''
+    day = day or _day()
+    sketch = memcache.get(_sketch_key(day))
+    if sketch is None:
+        return False
+    items = [[netloc, page_key, count, error] for (netloc, page_key), (count, error) in sketch.items()]
+    ReferrerSketch(key_name=day, items=json.dumps(items)).put()
+    return True
+
+def top_referrers(period=None, limit=50):
+    '''
+    Returns the (netloc, page_key, count) of the most frequent referrers on the
+    day of `period` (today by default), most frequent first.
+    '''
+    day = _day(period)
+    sketch = memcache.get(_sketch_key(day))
+    if sketch is None:
+        sketch = _load_sketch(day)
+    top = sorted(sketch.items(), key=lambda i: -i[1][0])[:limit]
+    return [(netloc, page_key, count) for (netloc, page_key), (count, error) in top]
+
 def get_period_and_count(name, period_type, period):
     period = PeriodType.find_scope(period_type, period)
     count = counter.load_and_get_count(name, period_type=period_type, period=period)
     return period, count
-
@@ -114,6 +114,8 @@ def url2png(url, bounds=None):
     public_key = settings.url2png['user']
     if not bounds:
         bounds = settings.url2png['bounds']
+    if settings.url2png['fake']:
+        return '//%s%s' % (request.host, url_for('views.fake_url2png', bounds=bounds, url=url))
     token = hashlib.md5( "%s+%s" % (settings.url2png['password'], url) ).hexdigest()
     return "//api.url2png.com/v3/%s/%s/%s/%s" % (public_key, token, bounds, url)
 
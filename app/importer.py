@@ -0,0 +1,315 @@
+import re
+import time
+import codecs
+import logging
+from collections import deque
+from urlparse import urljoin, urlparse
+from BeautifulSoup import BeautifulSoup
+from google.appengine.api import urlfetch
+from cssutils import CSSParser, replaceUrls
+from cssutils.tokenize2 import Tokenizer
+import settings
+
+# Stylesheets are imported in as few passes as possible: every sheet a page
+# links to is fetched at once with async urlfetch, then every sheet those
+# @import, and so on, up to settings.importer['max_depth'] levels deep. The
+# result is put together in memory; only when a task is about to run out of
+# time is the rest left for the next one (see tasks.do_import).
+#
+# Sheets are copied as they are, only with their relative urls made absolute,
+# using just cssutils' tokenizer. Parsing them into a CSSOM instead validates
+# and reformats them, but takes far longer; see settings.importer['validate'].
+# @imports that weren't fetched are left for the browser, moved to the top of
+# the imported styles by hoist_imports since they're ignored after any rule.
+
+_newline_re = re.compile(r'\n')
+_import_re = re.compile(r'''(/\*.*?\*/)|@import\s+(?:url\(\s*(['"]?)(.*?)\2\s*\)|(['"])(.*?)\4)\s*([^;{}]*);''', re.S | re.I)
+_hoist_re = re.compile(_import_re.pattern + r'[ \t]*\n?', re.S | re.I) # with the rest of its line
+
+def _no_fetch(url):
+    # @imports are followed before parsing; don't let cssutils fetch any that weren't.
+    return None
+
+def _source(url, media=None, css=None):
+    # How a stylesheet to import is described, also in Importer.sources
+    if media and media.strip().lower() == 'all':
+        media = None
+    return {'url': url, 'media': media, 'css': css}
+
+def find_sources(page, exclude_netloc):
+    '''
+    Fetch `page` and return the stylesheets it uses, in document order, and
+    any errors. <link>ed sheets served from `exclude_netloc` are left out.
+    '''
+    resp = urlfetch.fetch(page.url, deadline=settings.importer['fetch_deadline'])
+    if resp.status_code != 200:
+        return [], ['Error fetching %s (status %s)' % (page.url, resp.status_code)]
+    sources = []
+    soup = BeautifulSoup(resp.content)
+    for tag in soup.findAll(re.compile(r'^(link|style)$')):
+        if tag.name == 'link':
+            if tag.get('href', None) and tag.get('rel', 'stylesheet').lower() == 'stylesheet':
+                url = urljoin(page.url, tag['href'])
+                if urlparse(url).netloc != exclude_netloc:
+                    sources.append(_source(url, tag.get('media', None)))
+        elif tag.name == 'style':
+            sources.append(_source(page.url, tag.get('media', None), ''.join(tag.contents).strip('\n')))
+    return sources, []
+
+def _decode(resp):
+    # The Content-Type charset wins, then a BOM or @charset, then utf-8.
+    encoding = None
+    for param in resp.headers.get('content-type', '').split(';')[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'charset':
+            encoding = value.strip().strip('"\'') or None
+    try:
+        return codecs.lookup('css')[1](resp.content, encoding=encoding)[0]
+    except (UnicodeDecodeError, LookupError):
+        return resp.content.decode('utf-8', 'replace')
+
+def _imports(css, base):
+    '''
+    Yields the (match, absolute url) of each @import rule in `css`.
+    '''
+    for match in _import_re.finditer(css):
+        href = match.group(3) or match.group(5)
+        if not match.group(1) and href:
+            yield match, urljoin(base, href.strip())
+
+def _absolute(href, url):
+    if not url or url.startswith('#'):
+        return url # fragments refer to the document itself, e.g. SVG filters
+    absolute = urljoin(href, url)
+    if '?' in url and '?' not in absolute:
+        # urljoin drops an empty query, which the IE @font-face hack
+        # (font.eot?#iefix) relies on.
+        path, hash, fragment = absolute.partition('#')
+        absolute = '%s?%s%s' % (path, hash, fragment)
+    return absolute
+
+def _quoted(string, href):
+    quote = string[0]
+    return '%s%s%s' % (quote, _absolute(href, string[1:-1]), quote)
+
+def _rewrite_urls(css, href):
+    '''
+    Make the relative url()s and @import strings in `css` absolute against
+    `href`, leaving everything else exactly as it was.
+    '''
+    lines = [0] + [match.end() for match in _newline_re.finditer(css)]
+    out = []
+    copied = 0 # css[:copied] is in out
+    pending = None # (start, replacement) of the last token, until it's known where it ends
+    importing = False
+    for name, value, line, col in Tokenizer().tokenize(css):
+        start = lines[line - 1] + col - 1
+        if pending:
+            out.append(css[copied:pending[0]])
+            out.append(pending[1])
+            copied = start
+            pending = None
+        if name == 'URI':
+            url = value[value.index('(') + 1:-1].strip()
+            if url[:1] in ('"', "'"):
+                url = _quoted(url, href)
+            else:
+                url = _absolute(href, url)
+            pending = (start, 'url(%s)' % url)
+        elif name == 'STRING' and importing:
+            pending = (start, _quoted(value, href))
+        elif name in ('CDO', 'CDC'):
+            pending = (start, '') # <!-- and --> around <style> contents
+        if name == 'IMPORT_SYM':
+            importing = True
+        elif name not in ('S', 'COMMENT'):
+            importing = False
+    if pending:
+        out.append(css[copied:pending[0]])
+        out.append(pending[1])
+    else:
+        out.append(css[copied:])
+    return ''.join(out)
+
+def _reformat(css, href):
+    parser = CSSParser(fetcher=_no_fetch)
+    try:
+        sheet = parser.parseString(css, href=href)
+        replaceUrls(sheet, lambda url: _absolute(href, url))
+        return sheet.cssText.decode(sheet.encoding or 'utf-8')
+    finally:
+        # Patch around AppEngine's frame inspection
+        del parser
+
+def _normalize(css, href):
+    if settings.importer['validate']:
+        return _reformat(css, href)
+    return _rewrite_urls(css, href)
+
+class _Batch(object):
+    '''
+    Fetches a batch of sources, and everything they @import, level by level.
+    '''
+    def __init__(self, sources, size):
+        self.sources = sources
+        self.size = size # bytes fetched so far, by this and earlier batches
+        self.sheets = {} # url -> css, or None if it couldn't be fetched
+        self.errors = []
+
+    def _skip(self, url):
+        self.sheets[url] = None
+        self.errors.append('Skipped %s, the imported styles are too big' % url)
+
+    def _fetch(self, urls):
+        # Up to concurrent_fetches at a time, starting more as they finish
+        # while there's room left under max_bytes.
+        options = settings.importer
+        pending = deque()
+        for url in urls:
+            if url not in self.sheets and url not in pending:
+                pending.append(url)
+        fetching = deque()
+        while pending or fetching:
+            while pending and len(fetching) < options['concurrent_fetches'] and self.size < options['max_bytes']:
+                url = pending.popleft()
+                rpc = urlfetch.create_rpc(deadline=options['fetch_deadline'])
+                urlfetch.make_fetch_call(rpc, url)
+                fetching.append((url, rpc))
+            if not fetching:
+                for url in pending:
+                    self._skip(url)
+                break
+            url, rpc = fetching.popleft()
+            self.sheets[url] = None
+            try:
+                resp = rpc.get_result()
+                if resp.status_code != 200:
+                    raise urlfetch.Error('Status %s' % resp.status_code)
+                if self.size + len(resp.content) > options['max_bytes']:
+                    self._skip(url)
+                    continue
+                self.sheets[url] = _decode(resp)
+                self.size += len(resp.content)
+            except Exception, e:
+                self.sheets[url] = None
+                self.errors.append('Error importing %s' % url)
+                logging.warn('Error importing %s: %s', url, e)
+
+    def fetch(self):
+        frontier = []
+        for source in self.sources:
+            if source['css'] is None:
+                frontier.append((source['url'], (source['url'],)))
+        self._fetch([url for url, parents in frontier])
+        for depth in range(settings.importer['max_depth']):
+            sheets = [(self.sheets[url], url, parents) for url, parents in frontier if self.sheets.get(url)]
+            sheets += [(source['css'], source['url'], ()) for source in self.sources if source['css'] and not depth]
+            frontier = []
+            for css, base, parents in sheets:
+                for match, url in _imports(css, base):
+                    if url not in parents:
+                        frontier.append((url, parents + (url,)))
+            if not frontier:
+                break
+            self._fetch([url for url, parents in frontier])
+
+    def _inline(self, css, base, parents):
+        # Each @import that was fetched is replaced by the sheet, in front of
+        # the rest. The (url, media) of the others are returned, to be left
+        # for the browser to follow from the top of the styles.
+        imports = []
+        imported = []
+        rest = []
+        last = 0
+        for match, url in _imports(css, base):
+            rest.append(css[last:match.start()])
+            last = match.end()
+            media = match.group(6).strip()
+            sheet = self.sheets.get(url) if url not in parents else None
+            if sheet is not None:
+                try:
+                    sheet_imports, sheet = self._inline(sheet, url, parents + (url,))
+                except Exception:
+                    self.errors.append('Error importing %s' % url)
+                    logging.exception('Error importing %s', url)
+                    sheet = None
+            if sheet is None:
+                imports.append((url, media))
+                continue
+            imports.extend(_with_media(sheet_imports, media))
+            if media:
+                sheet = '@media %s {\n%s\n}' % (media, sheet)
+            imported.append('/* Imported from %s */\n%s\n' % (url, sheet))
+        rest.append(css[last:])
+        return imports, ''.join(imported) + _normalize(''.join(rest), base)
+
+    def _assemble(self, source):
+        if source['css'] is None:
+            css = self.sheets.get(source['url'])
+            if css is None:
+                return ''
+            imports, css = self._inline(css, source['url'], (source['url'],))
+            header = '\n\n/* Imported from %s */\n' % source['url']
+        else:
+            imports, css = self._inline(source['css'], source['url'], ())
+            header = '/* Imported directly from %s */\n' % source['url']
+        if source['media']:
+            css = '@media %s {\n%s\n}' % (source['media'], css)
+        imports = _with_media(imports, source['media'])
+        return '%s%s%s\n' % (header, ''.join(_import_rule(url, media) for url, media in imports), css)
+
+    def assemble(self):
+        style = []
+        for source in self.sources:
+            try:
+                style.append(self._assemble(source))
+            except Exception:
+                # Just this source is left out
+                self.errors.append('Error importing %s' % source['url'])
+                logging.exception('Error importing %s', source['url'])
+        return ''.join(style)
+
+def _with_media(imports, media):
+    # @imports inside an @media block, moved out of it
+    if not media:
+        return imports
+    return [(url, own_media or media) for url, own_media in imports]
+
+def _import_rule(url, media):
+    return '@import url("%s")%s;\n' % (url.replace('"', '%22'), (' ' + media) if media else '')
+
+def hoist_imports(css):
+    '''
+    Move the @imports left in imported `css` to the top, since browsers
+    ignore any that come after other rules.
+    '''
+    imports = []
+    def hoist(match):
+        if match.group(1):
+            return match.group(0) # a comment
+        imports.append(match.group(0).rstrip() + '\n')
+        return ''
+    rest = _hoist_re.sub(hoist, css)
+    return ''.join(imports) + rest
+
+def import_sources(sources, deadline, size=0):
+    '''
+    Import `sources` (as returned by find_sources), at least one batch of
+    them and then more until the time.time() `deadline` gets close. Returns
+    the imported styles, any errors, the sources left to import and the size
+    fetched so far, to pass back in when continuing.
+    '''
+    options = settings.importer
+    # Enough time for one more batch, if every fetch takes as long as it may.
+    waves = -(-options['batch_size'] // options['concurrent_fetches'])
+    needed = (options['max_depth'] + 1) * waves * options['fetch_deadline']
+    style = []
+    errors = []
+    while sources and (not style or time.time() + needed < deadline):
+        batch = _Batch(sources[:options['batch_size']], size)
+        sources = sources[options['batch_size']:]
+        batch.fetch()
+        style.append(batch.assemble())
+        errors.extend(batch.errors)
+        size = batch.size
+    return ''.join(style), errors, sources, size
@@ -1,6 +1,7 @@
 import logging
 import traceback
-from models import StyleRevision, UserGroup, Site, Style, Page, Credential
+from google.appengine.ext import db
+from models import StyleRevision, UserGroup, Site, Style, Page, PageChannel, Credential
 
 _migrations = []
 def migration(f):
@@ -59,6 +60,36 @@ def add_creds():
     cred = Credential(name='empty')
     cred.put()
 
+@migration
+def move_channels_under_pages():
+    # Channels only live as long as an editor session, so just drop the old
+    # top-level ones; editors get new ones when they reload.
+    db.delete([key for key in PageChannel.all(keys_only=True) if key.parent() is None])
+
+@migration
+def move_preview_imgs():
+    # Page no longer has preview_img, so this works on the raw entities to
+    # move the images into PagePreviews and drop them from the pages.
+    from hashlib import sha1
+    from google.appengine.api import datastore
+    from models import PagePreview
+    pages = []
+    for entity in datastore.Query('Page').Run():
+        if 'preview_img' not in entity:
+            continue
+        img = entity.pop('preview_img')
+        if img:
+            digest = sha1(img).hexdigest()
+            PagePreview(key_name=str(entity.key()), img=db.Blob(img), digest=digest).put()
+            entity['preview_digest'] = digest
+            entity['preview_size'] = len(img)
+        pages.append(entity)
+        if len(pages) == 100:
+            datastore.Put(pages)
+            pages = []
+    if pages:
+        datastore.Put(pages)
+
 def get_migrations():
     return [f.func_name for f in _migrations]
 
@@ -1,28 +1,30 @@
-from logging import Formatter, Filter, StreamHandler
-import scss
 import settings
+import os
 import json
+import time
+import random
+import logging
+import threading
 from datetime import datetime
+from hashlib import sha1
+from base64 import b32encode
 from StringIO import StringIO
 from google.appengine.ext import db
 from google.appengine.api import users as gae_users
 from google.appengine.api import taskqueue
 from google.appengine.api import channel as gae_channels
 from google.appengine.api import files
-from google.appengine.api.datastore_errors import BadKeyError
+from google.appengine.api import memcache
+from google.appengine.api.datastore_errors import BadKeyError, BadRequestError
+from google.appengine.runtime.apiproxy_errors import RequestTooLargeError
 from flask import abort, url_for, render_template
+from compiler import compile_scss, compile_scss_with_stats, gzip_bytes, gunzip_bytes
 
 def dt_handler(obj):
     if isinstance(obj, datetime):
         return obj.isoformat() + 'Z'
     return None
 
-class ExceptionFilter(Filter):
-    def filter(self, record):
-        if record.getMessage().lower().startswith('exception'):
-            return 0
-        return 1
-
 # Old and dead...
 class UserGroup(db.Model):
     name = db.StringProperty(required=True)
@@ -32,6 +34,70 @@ class UserGroup(db.Model):
 class SchemaVersion(db.Model):
     version = db.IntegerProperty(required=True, default=0)
 
+class ShardedTotal(db.Model):
+    '''
+    One shard of a running total, such as the number of users. Shards are
+    keyed '<name>-<n>' and spread writes; the total is their sum, once it's
+    been reconciled against a full count (which marks shard 0).
+    '''
+    name = db.StringProperty(required=True)
+    count = db.IntegerProperty(required=True, default=0)
+    reconciled = db.BooleanProperty(default=False) # only set on shard 0
+
+    @staticmethod
+    def _keys(name):
+        return [db.Key.from_path('ShardedTotal', '%s-%d' % (name, n)) for n in range(settings.sharded_totals['shards'])]
+
+    @staticmethod
+    def increment(name, delta=1, shard=None):
+        '''
+        Add `delta` to a random shard of the total. Call this inside the
+        (cross-group) transaction that creates or deletes what's counted.
+        '''
+        if shard is None:
+            shard = random.randint(0, settings.sharded_totals['shards'] - 1)
+        key_name = '%s-%d' % (name, shard)
+        total = ShardedTotal.get_by_key_name(key_name) or ShardedTotal(key_name=key_name, name=name)
+        total.count += delta
+        total.put()
+
+    @staticmethod
+    def reconcile(name, drift):
+        '''
+        Correct the total by `drift` and mark it as reconciled, unless it
+        already was (by another count). Call this in a transaction; returns
+        whether the total was corrected.
+        '''
+        key_name = '%s-0' % name
+        total = ShardedTotal.get_by_key_name(key_name) or ShardedTotal(key_name=key_name, name=name)
+        if total.reconciled:
+            return False
+        total.count += drift
+        total.reconciled = True
+        total.put()
+        return True
+
+    @staticmethod
+    def get_shards(name):
+        '''
+        Returns the sum of the shards of a total, and whether it was ever
+        reconciled; until it is, the shards only count what happened since
+        they were introduced.
+        '''
+        shards = db.get(ShardedTotal._keys(name))
+        return sum(shard.count for shard in shards if shard), bool(shards[0] and shards[0].reconciled)
+
+    @staticmethod
+    def get_total(name):
+        '''
+        The current total, or None if it was never reconciled.
+        '''
+        total, reconciled = ShardedTotal.get_shards(name)
+        return total if reconciled else None
+
+def run_in_xg_transaction(function, *args, **kwargs):
+    return db.run_in_transaction_options(db.create_transaction_options(xg=True), function, *args, **kwargs)
+
 class Site(db.Model):
     name = db.StringProperty(required=True)
     owner = db.UserProperty()
@@ -39,10 +105,25 @@ class Site(db.Model):
     admins = db.ListProperty(gae_users.User)
     example = db.BooleanProperty(default=False)
 
+    def put(self, *args, **kwargs):
+        if self.is_saved() or self.example:
+            return super(Site, self).put(*args, **kwargs)
+        def create():
+            key = super(Site, self).put(*args, **kwargs)
+            ShardedTotal.increment('sites', 1)
+            return key
+        return run_in_xg_transaction(create)
+
     def delete(self):
         for page in self.page_set.fetch(10000):
             page.delete()
-        db.delete(self)
+        if self.example:
+            db.delete(self)
+            return
+        def remove():
+            db.delete(self)
+            ShardedTotal.increment('sites', -1)
+        run_in_xg_transaction(remove)
 
     @staticmethod
     def get_or_404(id):
@@ -66,103 +147,209 @@ class Invitation(db.Model):
     inviter = db.UserProperty(required=True)
     has_been_logged_out = db.BooleanProperty(default=False)
 
+class _StyleList(list):
+    '''
+    A page's loaded styles, remembering whether they were changed in place so
+    Page.put only re-derives the style keys when it has to.
+    '''
+    dirty = False
+
+def _style_list_mutator(name):
+    method = getattr(list, name)
+    def mutate(self, *args):
+        self.dirty = True
+        return method(self, *args)
+    mutate.__name__ = name
+    return mutate
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'reverse', 'sort',
+        '__setitem__', '__delitem__', '__setslice__', '__delslice__', '__iadd__', '__imul__'):
+    setattr(_StyleList, _name, _style_list_mutator(_name))
+del _name
+
 class Page(db.Model):
     name = db.StringProperty(required=True)
     url = db.LinkProperty(required=True)
     site = db.ReferenceProperty(Site)
     _styles = db.ListProperty(db.Key)
-    channels = db.ListProperty(db.Key)
-    preview_img = db.BlobProperty(required=False, default=None)
+    channels = db.ListProperty(db.Key) # Old and dead; PageChannels are children of their Page now
+    preview_digest = db.StringProperty(default=None) # sha1 of the PagePreview image
+    preview_size = db.IntegerProperty(default=None)
+    preview_source = db.StringProperty(default=None) # what the preview was captured from; see preview_source_for
     preview_urls = db.ListProperty(db.Link, default=None) # *additional* preview urls
     import_state = db.IntegerProperty(default=0)
     on_cdn = db.BooleanProperty(default=False)
 
     _style_cache = None
+    _revisions_loaded = False
     def _set_styles(self, styles):
-        self._style_cache = styles
+        self._style_cache = _StyleList(styles)
         self._styles = [style.key() for style in styles]
+        self._revisions_loaded = False
     def _get_styles(self):
-        if not self._style_cache:
-            self._style_cache = [Style.get(k) for k in self._styles]
+        if self._style_cache is None:
+            self._style_cache = _StyleList(db.get(self._styles))
+            self._revisions_loaded = False
         return self._style_cache
     styles = property(_get_styles, _set_styles)
 
+    def reload_styles(self):
+        '''
+        Forget the loaded styles, so they're fetched again when next used.
+        '''
+        self._style_cache = None
+        self._revisions_loaded = False
+
+    def _get_styles_with_revisions(self):
+        if not self._revisions_loaded:
+            Page.prefetch_styles([self])
+        return self.styles
+
+    @staticmethod
+    def prefetch_styles(pages):
+        '''
+        Load the styles of all `pages`, and then their published and preview
+        revisions, with one batch get each instead of a get per entity.
+        '''
+        missing = [page for page in pages if page._style_cache is None]
+        keys = [key for page in missing for key in page._styles]
+        styles = dict(zip(keys, db.get(keys))) if keys else {}
+        for page in missing:
+            page._style_cache = _StyleList(styles[key] for key in page._styles)
+        pages = [page for page in pages if not page._revisions_loaded]
+        Style.prefetch_revisions([style for page in pages for style in page.styles if style])
+        for page in pages:
+            page._revisions_loaded = True
+
     def delete(self):
-        for key in self.channels:
-            channel = PageChannel.get(key)
-            if channel:
-                channel.send_message({'cmd': 'lock'})
-                channel.delete()
+        channels = PageChannel.all().ancestor(self).fetch(1000)
+        lock_msg = {'cmd': 'lock'}
+        self.broadcast([(channel, lock_msg) for channel in channels if channel.member])
+        db.delete(channels)
+        memcache.delete(self._lock_state_key())
         for style in self.styles:
             style.delete()
-        db.delete(self)
+        PublishedBundle.discard(self)
+        db.delete([db.Key.from_path('PagePreview', str(self.key())), self])
 
     def clean_channels(self):
-        stale = []
-        for key in self.channels:
-            channel = PageChannel.get(key)
-            if not channel or channel.is_stale():
-                stale.append(key)
-        if stale:
-            for key in stale:
-                self.channels.remove(key)
-                channel = PageChannel.get(key)
-                if channel:
-                    # If the channel is still here, it's probably stale.
-                    # Send 'lock' and remove, so it can't clobber anyone else.
-                    channel.send_message({'cmd': 'lock'})
-                    channel.delete()
-            self.put()
+        stale = PageChannel.stale_channels(self.get_channels())
+        # Send 'lock' and remove, so it can't clobber anyone else.
+        lock_msg = {'cmd': 'lock'}
+        self.broadcast([(channel, lock_msg) for channel in stale])
+        db.delete(stale)
 
     def get_channels(self):
-        channels = []
-        stale = []
-        for key in self.channels:
-            channel = PageChannel.get(key)
-            if channel:
-                channels.append(channel)
-            else:
-                stale.append(key)
-        if stale:
-            for key in stale:
-                self.channels.remove(key)
-            self.put()
+        '''
+        The page's editor channels, in order; the first one holds the lock.
+        '''
+        channels = [channel for channel in PageChannel.all().ancestor(self) if channel.member]
+        channels.sort(key=lambda channel: channel.rank)
         return channels
 
-    def update_locks(self):
+    def broadcast(self, recipients):
+        '''
+        Send messages to many channels at once. `recipients` is a list of
+        (channel, message) pairs; each distinct message object is serialized
+        only once, and the sends run concurrently.
+        '''
+        serialized = {}
+        sends = []
+        for channel, message in recipients:
+            if id(message) not in serialized:
+                serialized[id(message)] = PageChannel.serialize(message)
+            sends.append(threading.Thread(target=gae_channels.send_message, args=(channel.client_id, serialized[id(message)])))
+        if len(sends) == 1:
+            sends[0].run()
+            return
+        for send in sends:
+            send.start()
+        for send in sends:
+            send.join()
+
+    def _lock_state_key(self):
+        return 'page-lock-state-%s' % self.key()
+
+    def update_locks(self, always=None):
+        '''
+        Tell the first channel it holds the lock and the others who does.
+        Channels are only sent a message when theirs changed since the last
+        update, except for the `always` channel (one that just joined).
+        '''
         owner = None
         channels = self.get_channels()
+        recipients = []
         if channels:
             owner_user = channels[0].user
             owner = dict(name=owner_user.nickname(), email=owner_user.email())
-            channels[0].send_message(dict(cmd='unlock', user=owner))
+            recipients.append((channels[0], dict(cmd='unlock', user=owner)))
         lock_msg = dict(cmd='lock', user=owner)
-        for channel in channels[1:]:
-            channel.send_message(lock_msg)
+        recipients.extend((channel, lock_msg) for channel in channels[1:])
+
+        last_sent = memcache.get(self._lock_state_key()) or {}
+        sent = dict((channel.client_id, message) for channel, message in recipients)
+        always_id = always.client_id if always else None
+        self.broadcast([(channel, message) for channel, message in recipients if channel.client_id == always_id or last_sent.get(channel.client_id) != message])
+        memcache.set(self._lock_state_key(), sent, time=settings.channel_heartbeat['stale_after'])
 
     def add_channel(self, channel):
-        self.remove_channel(channel)
-        self.channels.append(channel.key())
-        self.put()
+        channel.member = True
+        channel.rank = time.time()
+        channel.put()
 
     def add_channel_first(self, channel):
-        self.remove_channel(channel)
-        self.channels.insert(0, channel.key())
-        self.put()
+        channel.member = True
+        channel.rank = -time.time() # ahead of everyone, including earlier claims
+        channel.put()
 
     def remove_channel(self, channel, delete=False):
-        if channel.key() in self.channels:
-            self.channels.remove(channel.key())
-            self.put()
         if delete:
             channel.delete()
+        elif channel.member:
+            channel.member = False
+            channel.put()
 
     def put(self, *args, **kwargs):
-        self._set_styles(self.styles)
+        # Styles that were never loaded, or loaded and left alone, can't have changed.
+        if self._style_cache is not None and self._style_cache.dirty:
+            self._set_styles(self._style_cache)
         super(Page, self).put(*args, **kwargs)
 
+    def set_preview(self, img, source=None):
+        digest = sha1(img).hexdigest()
+        PagePreview(key_name=str(self.key()), img=db.Blob(img), digest=digest).put()
+        self.preview_digest = digest
+        self.preview_size = len(img)
+        self.preview_source = source
+        self.put()
+
+    def preview_source_for(self):
+        '''
+        Identifies what a preview captured now would show: the page's url, as
+        styled by its published CSS.
+        '''
+        return sha1('%s\n%s' % (self.url, PublishedBundle.get_for_page(self).etag)).hexdigest()
+
+    def get_preview(self):
+        if not self.preview_digest:
+            return None
+        return PagePreview.get_by_key_name(str(self.key()))
+
+    @property
+    def preview_version(self):
+        '''
+        Identifies the current preview image in its url, so it can be cached for good.
+        '''
+        return self.preview_digest[:16] if self.preview_digest else None
+
     def queue_preview(self):
-        taskqueue.add(queue_name='fetch-preview', url=url_for('tasks.fetch_preview'), params={'page_key': self.key()})
+        taskqueue.Queue('preview-requests').add(taskqueue.Task(payload=str(self.key()), method='PULL'))
+        # One worker per batch_delay window takes everything queued meanwhile.
+        window = int(time.time()) // settings.previews['batch_delay']
+        try:
+            taskqueue.add(queue_name='fetch-preview', url=url_for('tasks.fetch_previews'), name='fetch-previews-%d' % window, countdown=settings.previews['batch_delay'])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
 
     def queue_upload(self):
         taskqueue.add(queue_name='upload-css', url=url_for('tasks.upload_style'), params={'page_key': self.key()})
@@ -173,12 +360,12 @@ class Page(db.Model):
 
     def _css(self, preview, compress):
         css = StringIO()
-        for style in self.styles:
+        for style in self._get_styles_with_revisions():
             rev = style.preview_rev if (preview and style.preview_rev) else style.published_rev
             if compress:
                 css.write(rev.compressed)
             else:
-                css.write(scss.Scss().compile('@option compress:no;' + rev.raw))
+                css.write(compile_scss(rev.raw, compress=False)[0])
         return css.getvalue()
 
     def compressed_css(self, preview):
@@ -189,17 +376,34 @@ class Page(db.Model):
 
     def last_modified(self, preview):
         max_last_edit = datetime.min
-        for style in self.styles:
+        for style in self._get_styles_with_revisions():
             rev = style.preview_rev if (preview and style.preview_rev) else style.published_rev
             max_last_edit = max(max_last_edit, rev.dt_last_edit)
         return max_last_edit
 
+    def css_stats(self, preview):
+        '''
+        Size, gzipped size, rule count and compile time of the page's CSS,
+        added up from what its revisions recorded when they were compiled.
+        Stats a revision never recorded are None.
+        '''
+        stats = dict(size=0, gzip_size=0, rule_count=0, compile_ms=0)
+        for style in self._get_styles_with_revisions():
+            rev = style.preview_rev if (preview and style.preview_rev) else style.published_rev
+            rev_stats = dict(size=rev.compressed_size, gzip_size=rev.gzip_size, rule_count=rev.rule_count, compile_ms=rev.compile_ms)
+            if rev_stats['size'] is None:
+                # Compiled before we kept stats
+                rev_stats['size'] = len((rev.compressed or u'').encode('utf-8'))
+            for name, value in rev_stats.items():
+                stats[name] = None if (stats[name] is None or value is None) else stats[name] + value
+        return stats
+
     def styles_json(self):
         # NOTE: It is okay to return an array here because we only display this
         # to users via editor.html. If we ever return this directly as the
         # response, we'll want to wrap it to avoid the exploit described at
         # http://haacked.com/archive/2009/06/25/json-hijacking.aspx
-        styles_obj = [style.json_obj() for style in self.styles]
+        styles_obj = [style.json_obj() for style in self._get_styles_with_revisions()]
         return json.dumps(styles_obj, default=dt_handler, sort_keys=True, indent=4 if settings.debug else None)
 
     def upload_to_cdn(self):
@@ -208,7 +412,7 @@ class Page(db.Model):
         path = files.gs.create('/gs/%s/%s.css' % (settings.google_bucket, str(self.key())), mime_type='text/css', acl='public-read', cache_control='private,max-age=300')
         try:
             fd = files.open(path, 'a')
-            fd.write(self.compressed_css(False).encode('utf-8'))
+            fd.write(PublishedBundle.get_for_page(self).css)
             self.on_cdn = True
             self.save()
         except Exception:
@@ -274,6 +478,158 @@ class Page(db.Model):
         page.queue_refresh()
         return page
 
+class PagePreview(db.Model):
+    '''
+    A page's preview image, kept apart so fetching the page doesn't load it.
+    Keyed by the page key.
+    '''
+    img = db.BlobProperty(required=True)
+    digest = db.StringProperty(required=True)
+
+class CachedBundle(object):
+    '''
+    What's kept of a PublishedBundle in memcache: all but the uncompressed
+    CSS, which could take it over memcache's 1MB limit and is only needed for
+    the few clients that don't accept gzip.
+    '''
+    def __init__(self, bundle):
+        self.gzipped = bundle.gzipped
+        self.etag = bundle.etag
+        self.dt_last_modified = bundle.dt_last_modified
+        self.generation = bundle.generation
+
+    @property
+    def css(self):
+        return gunzip_bytes(self.gzipped)
+
+    @property
+    def version(self):
+        return self.etag[:16]
+
+class PublishedBundle(db.Model):
+    '''
+    The published CSS of a page, materialized when it's published so that
+    serving it never has to touch the page's styles. Keyed by the page key.
+    '''
+    css = db.BlobProperty(required=True) # utf-8
+    gzipped = db.BlobProperty(required=True)
+    etag = db.StringProperty(required=True)
+    dt_last_modified = db.DateTimeProperty(required=True)
+    generation = db.IntegerProperty(default=0) # incremented by every publish
+
+    @property
+    def version(self):
+        '''
+        Identifies this content in versioned CSS urls.
+        '''
+        return self.etag[:16]
+
+    @staticmethod
+    def _cache_key(page_key):
+        return '%s-css-bundle' % page_key
+
+    @staticmethod
+    def _cache(cache_key, bundle, time=0):
+        try:
+            cached = memcache.set(cache_key, CachedBundle(bundle), time=time)
+        except ValueError:
+            cached = False
+        if not cached:
+            logging.warn('Could not cache published bundle %s', cache_key)
+        return cached
+
+    @staticmethod
+    def publish(page):
+        '''
+        Build and store the bundle for the page's currently published styles,
+        writing it straight through to memcache.
+        '''
+        css = page.compressed_css(False).encode('utf-8')
+        etag = sha1(css).hexdigest()
+        page_key = str(page.key())
+        previous = PublishedBundle.get_by_key_name(page_key)
+        # Stamped by the publish, not the revisions: removing a style changes
+        # the content without any revision changing.
+        dt_last_modified = datetime.utcnow()
+        if previous and previous.etag == etag:
+            dt_last_modified = previous.dt_last_modified
+        elif previous:
+            dt_last_modified = max(dt_last_modified, previous.dt_last_modified)
+        bundle = PublishedBundle(
+            key_name = page_key,
+            css = css,
+            gzipped = gzip_bytes(css),
+            etag = etag,
+            dt_last_modified = dt_last_modified,
+            generation = (previous.generation + 1) if previous else 1,
+        )
+        try:
+            bundle.put()
+        except (RequestTooLargeError, BadRequestError):
+            # Too big for a single entity. Drop the previous one so it isn't
+            # served instead; _load then rebuilds the bundle on memcache misses.
+            logging.warn('Could not store published bundle for page %s', page_key)
+            db.delete(bundle.key())
+        cache_key = PublishedBundle._cache_key(page_key)
+        PublishedBundle._cache(cache_key, bundle, time=settings.published_bundle['memcache_time'])
+        PublishedBundle._cache(cache_key + '-stale', bundle)
+        return bundle
+
+    @staticmethod
+    def discard(page):
+        page_key = str(page.key())
+        cache_key = PublishedBundle._cache_key(page_key)
+        memcache.delete_multi([cache_key, cache_key + '-stale'])
+        db.delete(db.Key.from_path('PublishedBundle', page_key))
+
+    @staticmethod
+    def _load(page):
+        '''
+        Returns the stored bundle for a page or page key, and whether it was
+        asked for by its canonical key.
+        '''
+        page_key = str(page.key()) if isinstance(page, Page) else page
+        bundle = PublishedBundle.get_by_key_name(page_key)
+        if bundle is not None:
+            return bundle, True
+        if not isinstance(page, Page):
+            page = Page.get_or_404(page_key)
+        canonical = str(page.key()) == page_key
+        # Pages that haven't been published since bundles existed get one now, as
+        # do ones whose bundle is too big to store.
+        return PublishedBundle.get_by_key_name(str(page.key())) or PublishedBundle.publish(page), canonical
+
+    @staticmethod
+    def get_for_page(page):
+        '''
+        The bundle for a page or the page key it was requested with, either a
+        PublishedBundle or, from memcache, a CachedBundle. On a memcache miss
+        only one request at a time rebuilds it; the others serve the previous
+        bundle meanwhile.
+        '''
+        page_key = str(page.key()) if isinstance(page, Page) else page
+        cache_key = PublishedBundle._cache_key(page_key)
+        stale_key = cache_key + '-stale'
+        cached = memcache.get_multi([cache_key, stale_key])
+        if cache_key in cached:
+            return cached[cache_key]
+        stale = cached.get(stale_key)
+        lock_key = cache_key + '-lock'
+        locked = memcache.add(lock_key, 1, time=settings.published_bundle['rebuild_lock_time'])
+        if not locked and stale is not None:
+            return stale
+        try:
+            bundle, canonical = PublishedBundle._load(page)
+            if locked:
+                # add, not set, so a publish that happened meanwhile wins.
+                memcache.add(cache_key, CachedBundle(bundle), time=settings.published_bundle['memcache_time' if canonical else 'alias_memcache_time'])
+                if stale is None or stale.generation <= bundle.generation:
+                    PublishedBundle._cache(stale_key, bundle)
+        finally:
+            if locked:
+                memcache.delete(lock_key)
+        return bundle
+
 class StyleRevision(db.Model):
     # parent = Style
     rev = db.IntegerProperty(required=True, default=0)
@@ -281,22 +637,21 @@ class StyleRevision(db.Model):
     dt_last_edit = db.DateTimeProperty(auto_now=True)
     raw = db.TextProperty(required=False, default='')
     compressed = db.TextProperty(required=False, default=None)
+    # Recorded by update(); sizes are in bytes, compile_ms is how long the compile took, even if it was cached.
+    compressed_size = db.IntegerProperty(default=None)
+    gzip_size = db.IntegerProperty(default=None)
+    rule_count = db.IntegerProperty(default=None)
+    compile_ms = db.IntegerProperty(default=None)
     # Old and dead...
     css = db.TextProperty(required=False)
     _cached = db.TextProperty(required=False)
 
     def update(self, raw):
         self.raw = raw
-        log = StringIO()
-        handler = StreamHandler(log)
-        handler.addFilter(ExceptionFilter())
-        handler.setFormatter(Formatter('<span class="level">%(levelname)s</span>: <span class="message">%(message)s</span><br />'))
-        scss.log.addHandler(handler)
-        self.compressed = scss.Scss().compile(self.raw)
-        scss.log.removeHandler(handler)
-        handler.flush()
+        self.compressed, log, self.compile_ms, stats = compile_scss_with_stats(self.raw)
+        self.compressed_size, self.gzip_size, self.rule_count = stats
         self.put()
-        return log.getvalue()
+        return log
 
 class Style(db.Model):
     site = db.ReferenceProperty(Site)
@@ -313,6 +668,21 @@ class Style(db.Model):
         db.delete(revisions)
         db.delete(self)
 
+    @staticmethod
+    def prefetch_revisions(styles):
+        '''
+        Resolve the published and preview revisions of all `styles` with a
+        single batch get.
+        '''
+        refs = [(style, prop, prop.get_value_for_datastore(style)) for style in styles for prop in (Style.published_rev, Style.preview_rev)]
+        keys = list(set(key for style, prop, key in refs if key))
+        if not keys:
+            return
+        revs = dict(zip(keys, db.get(keys)))
+        for style, prop, key in refs:
+            if key and revs[key]:
+                setattr(style, prop.name, revs[key])
+
     def json_obj(self):
         if self.preview_rev:
             preview_rev = self.preview_rev
@@ -358,28 +728,104 @@ class Style(db.Model):
         return style
 
 class PageChannel(db.Model):
+    # parent = Page, key_name = client_id
     user = db.UserProperty(required=True)
     page = db.ReferenceProperty(Page, required=True)
     token = db.StringProperty(required=True)
     client_id = db.StringProperty(required=True)
     dt_connected = db.DateTimeProperty(auto_now_add=True)
     dt_last_update = db.DateTimeProperty(auto_now_add=True)
+    member = db.BooleanProperty(default=False) # connected to the page's editor
+    rank = db.FloatProperty(default=0.0) # position among the page's channels
 
-    def is_stale(self):
-        return (datetime.utcnow() - self.dt_last_update).seconds > 3600
+    def _heartbeat_key(self):
+        return 'channel-heartbeat-%s' % self.client_id
 
-    def send_message(self, message):
+    def heartbeat(self):
+        '''
+        Note that the channel is alive. That's recorded in memcache every time,
+        but only written to the datastore once per write_interval.
+        '''
+        now = datetime.utcnow()
+        memcache.set(self._heartbeat_key(), now, time=settings.channel_heartbeat['stale_after'])
+        if (now - self.dt_last_update).total_seconds() >= settings.channel_heartbeat['write_interval']:
+            self.dt_last_update = now
+            self.put()
+
+    def is_stale(self, heartbeat=None):
+        '''
+        `heartbeat` is the channel's last heartbeat from memcache, if the caller
+        already fetched it.
+        '''
+        last_update = self.dt_last_update
+        if heartbeat is None:
+            heartbeat = memcache.get(self._heartbeat_key())
+        if heartbeat and heartbeat > last_update:
+            last_update = heartbeat
+        return (datetime.utcnow() - last_update).total_seconds() > settings.channel_heartbeat['stale_after']
+
+    @staticmethod
+    def stale_channels(channels):
+        heartbeats = memcache.get_multi([channel._heartbeat_key() for channel in channels])
+        return [channel for channel in channels if channel.is_stale(heartbeats.get(channel._heartbeat_key(), False))]
+
+    @staticmethod
+    def serialize(message):
         if not isinstance(message, basestring):
             message = json.dumps(message, default=dt_handler, sort_keys=True, indent=4 if settings.debug else None)
-        gae_channels.send_message(self.client_id, message)
+        return message
+
+    def send_message(self, message):
+        gae_channels.send_message(self.client_id, PageChannel.serialize(message))
+
+    @staticmethod
+    def new_channel(page, user):
+        client_id = 'page-%d-%s-%s' % (page.key().id(), user.user_id(), b32encode(os.urandom(10)))
+        token = gae_channels.create_channel(client_id)
+        channel = PageChannel(parent=page, key_name=client_id, user=user, page=page, token=token, client_id=client_id)
+        channel.put()
+        memcache.set(PageChannel._token_key(token), client_id, time=settings.channel_heartbeat['stale_after'])
+        return channel
+
+    @staticmethod
+    def _token_key(token):
+        return 'channel-token-%s' % token
+
+    @staticmethod
+    def _key_for(client_id):
+        # client ids start with 'page-<page id>-'
+        try:
+            page_id = int(client_id.split('-')[1])
+        except (IndexError, ValueError):
+            return None
+        return db.Key.from_path('Page', page_id, 'PageChannel', client_id)
+
+    @staticmethod
+    def get_by_client_id(client_id):
+        key = PageChannel._key_for(client_id)
+        channel = PageChannel.get(key) if key else None
+        if not channel:
+            # Channels created before they were keyed by client id
+            channel = PageChannel.gql('WHERE client_id=:1', client_id).get()
+        return channel
+
+    @staticmethod
+    def get_by_token(token):
+        client_id = memcache.get(PageChannel._token_key(token))
+        if client_id:
+            return PageChannel.get_by_client_id(client_id)
+        channel = PageChannel.gql('WHERE token=:1', token).get()
+        if channel:
+            memcache.set(PageChannel._token_key(token), channel.client_id, time=settings.channel_heartbeat['stale_after'])
+        return channel
 
     @staticmethod
     def get_or_404(token=None, client_id=None):
         channel = None
         if token:
-            channel = PageChannel.gql('WHERE token=:1', token).get()
+            channel = PageChannel.get_by_token(token)
         elif client_id:
-            channel = PageChannel.gql('WHERE client_id=:1', client_id).get()
+            channel = PageChannel.get_by_client_id(client_id)
         if not channel:
             abort(404)
         return channel
@@ -393,12 +839,29 @@ class UserSettings(db.Model):
     locale = db.StringProperty(default=None)
     chimped = db.BooleanProperty(default=False)
 
+    @staticmethod
+    def get_or_insert_for(user):
+        '''
+        Like get_or_insert, but counts the new user in the 'users' total.
+        '''
+        settings = UserSettings.get_by_key_name(user.user_id())
+        if settings:
+            return settings
+        def create():
+            settings = UserSettings.get_by_key_name(user.user_id())
+            if not settings:
+                settings = UserSettings(key_name=user.user_id(), user=user)
+                settings.put()
+                ShardedTotal.increment('users', 1)
+            return settings
+        return run_in_xg_transaction(create)
+
     @staticmethod
     def has_seen_example():
         user = gae_users.get_current_user()
         if not user or not user.user_id():
             raise Exception("Logged in user expected")
-        settings = UserSettings.get_or_insert(user.user_id(), user=user)
+        settings = UserSettings.get_or_insert_for(user)
         return settings.seen_example
 
     @staticmethod
@@ -406,7 +869,7 @@ class UserSettings(db.Model):
         user = gae_users.get_current_user()
         if not user or not user.user_id():
             raise Exception("Logged in user expected")
-        settings = UserSettings.get_or_insert(user.user_id(), user=user)
+        settings = UserSettings.get_or_insert_for(user)
         settings.seen_example = True
         settings.put()
 
@@ -415,7 +878,7 @@ class UserSettings(db.Model):
         user = gae_users.get_current_user()
         if not user or not user.user_id():
             return False
-        settings = UserSettings.get_or_insert(user.user_id(), user=user)
+        settings = UserSettings.get_or_insert_for(user)
         return (guider_name not in settings.seen_guiders)
 
     @staticmethod
@@ -423,7 +886,7 @@ class UserSettings(db.Model):
         user = gae_users.get_current_user()
         if not user or not user.user_id():
             return
-        settings = UserSettings.get_or_insert(user.user_id(), user=user)
+        settings = UserSettings.get_or_insert_for(user)
         if not guider_name in settings.seen_guiders:
             settings.seen_guiders.append(guider_name)
             settings.put()
@@ -433,7 +896,7 @@ class UserSettings(db.Model):
         user = gae_users.get_current_user()
         if not user or not user.user_id():
             return True # don't bother displaying "new version available" to non-authenticated users
-        settings = UserSettings.get_or_insert(user.user_id(), user=user)
+        settings = UserSettings.get_or_insert_for(user)
         if not settings.seen_version:
             settings.seen_version = [0, 0, 0]
             settings.put()
@@ -444,7 +907,7 @@ class UserSettings(db.Model):
         user = gae_users.get_current_user()
         if not user or not user.user_id():
             return
-        settings = UserSettings.get_or_insert(user.user_id(), user=user)
+        settings = UserSettings.get_or_insert_for(user)
         settings.seen_version = version
         settings.put()
 
@@ -453,7 +916,7 @@ class UserSettings(db.Model):
         user = gae_users.get_current_user()
         if not user or not user.user_id():
             return None
-        settings = UserSettings.get_or_insert(user.user_id(), user=user)
+        settings = UserSettings.get_or_insert_for(user)
         return settings.locale
 
     @staticmethod
@@ -461,15 +924,23 @@ class UserSettings(db.Model):
         user = gae_users.get_current_user()
         if not user or not user.user_id():
             return
-        settings = UserSettings.get_or_insert(user.user_id(), user=user)
+        settings = UserSettings.get_or_insert_for(user)
         settings.locale = locale
         settings.put()
 
+class ReferrerSketch(db.Model):
+    # key_name = the day, as scoped by livecount's PeriodType.DAY
+    items = db.TextProperty(required=True) # json list of [netloc, page_key, count, error]
+    dt_saved = db.DateTimeProperty(auto_now=True)
+
 class Importer(db.Model):
+    # Only saved when an import takes more than one task; see tasks.do_import.
     page = db.ReferenceProperty(Page)
-    urls = db.StringListProperty()
+    urls = db.StringListProperty() # Old and dead; replaced by sources
+    sources = db.TextProperty(default=None) # json list of the stylesheets left to import
     style = db.TextProperty()
     errors = db.StringListProperty()
+    size = db.IntegerProperty(default=0) # bytes fetched so far
 
 class Credential(db.Model):
     name = db.StringProperty()
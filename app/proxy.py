@@ -37,7 +37,9 @@ def check_for_tags(url, page_key):
     script_url = url_for('js', page_key=page_key, _external=True)
     if status == 200:
         for link in soup.findAll('link'):
-            if link.get('href', '') == link_url:
+            href = link.get('href', '')
+            # Either the embed tag, or a versioned url for the same page
+            if href == link_url or (href.startswith(link_url + '/') and href.endswith('.css')):
                 resp['has_link'] = True
         for script in soup.findAll('script'):
             if script.get('src', '') == script_url:
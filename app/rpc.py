@@ -1,10 +1,9 @@
 import logging
-from datetime import datetime
 import json
-from google.appengine.api import memcache
 from flask import Module, request, abort, jsonify
 from flaskext.csrf import csrf_exempt
-from models import Page, PageChannel, Style, StyleRevision
+from models import Page, PageChannel, Style
+from saves import save_style
 from decorators import requires_auth, as_json
 
 rpc = Module(__name__, 'rpc')
@@ -28,44 +27,28 @@ def page_rpc(page_id):
         logging.warn('RPC received no cmd.')
         abort(400)
 
-    channel = PageChannel.gql('WHERE token=:1', token).get()
+    channel = PageChannel.get_by_token(token)
     if not channel:
         # We've timed out the channel. User should refresh the page.
         logging.debug('Could not find token: %s', token)
         return dict(cmd='refresh')
-    channel.dt_last_update = datetime.utcnow()
-    channel.put()
+    channel.heartbeat()
 
     # Commands
     if cmd == 'open':
         page.add_channel(channel)
-        page.update_locks()
+        page.update_locks(always=channel)
         return 'OK'
     elif cmd == 'claimLock':
         page.clean_channels()
         page.add_channel_first(channel)
-        page.update_locks()
+        page.update_locks(always=channel)
         return 'OK'
     elif cmd == 'save':
         style_id = data.get('style_id', '')
         style = Style.get_edit_or_404(style_id)
-        if not style.preview_rev:
-            preview_rev = StyleRevision(parent=style, rev=style.published_rev.rev + 1)
-            preview_rev.put()
-            style.preview_rev = preview_rev
-            style.put()
-        log = style.preview_rev.update(data.get('scss', ''))
-        publish = data.get('fPublish', False)
-        preview = not publish
-        if publish:
-            style.published_rev = style.preview_rev
-            style.preview_rev = None
-            style.put()
-            page_key = str(page.key())
-            memcache.delete(page_key + '-css')
-            memcache.delete(page_key + '-css-etag')
-            page.queue_refresh()
-        return jsonify({'css': page.compressed_css(preview), 'log': log})
+        result = save_style(page, style, data.get('scss', ''), bool(data.get('fPublish', False)))
+        return jsonify(result)
     else:
         logging.warn('Got a bad command: %s', cmd)
         abort(400) # Bad cmd
@@ -78,8 +61,9 @@ def _channel_presence(presence):
     page = channel.page
     if presence == 'connected':
         page.add_channel(channel)
+        page.update_locks(always=channel)
     elif presence == 'disconnected':
         page.remove_channel(channel, True)
-    page.update_locks()
+        page.update_locks()
     return 'OK'
 
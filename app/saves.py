@@ -0,0 +1,120 @@
+import time
+import logging
+from flask import abort
+from google.appengine.api import memcache
+from models import Style, StyleRevision, PublishedBundle
+import settings
+
+# Editor saves of a style are coalesced: while one request compiles the style,
+# newer saves replace the pending one (latest wins), and requests whose save
+# was superseded answer with the newest result instead of compiling their own.
+# Publishes are never superseded; they wait for the style and then run.
+# Nothing is written without holding the style's lock, so an older save can't
+# land over a newer one. Memcache only gets the outcome of a save, not the
+# page's CSS, which can be over its 1MB limit; requests answering with someone
+# else's save read the CSS from the revisions it wrote. See
+# settings.save_coalescing.
+
+def _key(style, what):
+    return 'style-save-%s-%s' % (what, style.key())
+
+def _write(page, style, scss, publish):
+    style = Style.get(style.key()) # fresh, since another save may have changed it
+    if not style.preview_rev:
+        preview_rev = StyleRevision(parent=style, rev=style.published_rev.rev + 1)
+        preview_rev.put()
+        style.preview_rev = preview_rev
+        style.put()
+    log = style.preview_rev.update(scss)
+    if publish:
+        style.published_rev = style.preview_rev
+        style.preview_rev = None
+        style.put()
+    page.reload_styles()
+    if publish:
+        PublishedBundle.publish(page)
+        page.queue_refresh()
+    return {'css': page.compressed_css(not publish), 'log': log}
+
+def _offer(style, seq, scss):
+    # Replace the pending save, unless a newer one got there first.
+    key = _key(style, 'pending')
+    client = memcache.Client()
+    for attempt in range(5):
+        pending = client.gets(key)
+        if pending is None:
+            if client.add(key, (seq, scss), time=settings.save_coalescing['lock_time']):
+                return
+        elif pending[0] >= seq or client.cas(key, (seq, scss), time=settings.save_coalescing['lock_time']):
+            return
+
+def _finished(style, seq, result, published):
+    # Only called with the lock held, so nothing else writes the result meanwhile.
+    done = memcache.get(_key(style, 'outcome'))
+    if done and done[0] > seq:
+        return
+    memcache.set(_key(style, 'outcome'), (seq, result['log'], published), time=settings.save_coalescing['lock_time'])
+
+def _answer(page, done):
+    # The page's CSS as the finished save `done` left it
+    seq, log, published = done
+    page.reload_styles()
+    return {'css': page.compressed_css(not published), 'log': log}
+
+def _drain(page, style, seq, scss):
+    # Compile the newest pending save until there's nothing newer than the
+    # last result; a few rounds at most, waiting requests take over after that.
+    written = {}
+    for attempt in range(3):
+        pending = memcache.get(_key(style, 'pending'))
+        done = memcache.get(_key(style, 'outcome'))
+        if not pending or (done and pending[0] <= done[0]):
+            break
+        written[pending[0]] = _write(page, style, pending[1], False)
+        _finished(style, pending[0], written[pending[0]], False)
+    done = memcache.get(_key(style, 'outcome'))
+    if done and done[0] >= seq:
+        return written.get(done[0]) or _answer(page, done)
+    # Our save got lost from memcache; do it ourselves.
+    result = _write(page, style, scss, False)
+    _finished(style, seq, result, False)
+    return result
+
+def save_style(page, style, scss, publish=False):
+    '''
+    Save `scss` as the preview of `style` (one of `page`'s), publishing it if
+    asked to, and return the page's CSS and the compile log for the editor.
+    '''
+    options = settings.save_coalescing
+    # Sequence numbers start from the clock, so they keep growing even if
+    # memcache forgets the counter while an older result is still around.
+    seq = memcache.incr(_key(style, 'seq'), initial_value=int(time.time() * 1000)) if options['enabled'] else None
+    if seq is None:
+        return _write(page, style, scss, publish)
+    if not publish:
+        _offer(style, seq, scss)
+        if options['debounce_ms']:
+            time.sleep(options['debounce_ms'] / 1000.0)
+    deadline = time.time() + options['wait']
+    while True:
+        if not publish:
+            done = memcache.get(_key(style, 'outcome'))
+            if done and done[0] >= seq:
+                return _answer(page, done)
+        if memcache.add(_key(style, 'lock'), seq, time=options['lock_time']):
+            try:
+                if publish:
+                    result = _write(page, style, scss, True)
+                    _finished(style, seq, result, True)
+                    return result
+                return _drain(page, style, seq, scss)
+            finally:
+                # Unless it expired and was taken over meanwhile
+                if memcache.get(_key(style, 'lock')) == seq:
+                    memcache.delete(_key(style, 'lock'))
+        if time.time() > deadline:
+            # The lock expires after lock_time, so this means others keep
+            # taking it; let the editor try again rather than write unlocked.
+            logging.warn('Gave up waiting for save %d of style %s', seq, style.key())
+            abort(503)
+        time.sleep(options['poll_ms'] / 1000.0)
@@ -1,18 +1,19 @@
-import re
+import json
+import time
 from datetime import datetime
 import logging
-from urlparse import urljoin, urlparse
-from BeautifulSoup import BeautifulSoup
+from urlparse import urlparse
 from flask import Module, request, render_template, url_for
 from flaskext.csrf import csrf_exempt
-from google.appengine.ext.db import GqlQuery
-from google.appengine.api import urlfetch, taskqueue
-from cssutils import CSSParser
+from google.appengine.ext import db
+from google.appengine.api import urlfetch, taskqueue, images
 from livecount import counter
 from livecount.counter import PeriodType
 from extensions import url2png
-from models import Page, Importer, StyleRevision
-from count import count_view
+from models import Page, Importer, StyleRevision, Site, UserSettings, ShardedTotal
+import settings
+from count import count_view, persist_referrers
+from importer import find_sources, import_sources, hoist_imports
 
 tasks = Module(__name__, 'tasks')
 
@@ -24,34 +25,155 @@ CAN_IMPORT = 4
 
 WEBPUTTY_LIST_ID = 'f734b59b78'
 
+# What each sharded total counts
+_total_queries = {
+    'users': lambda: UserSettings.all(keys_only=True),
+    'sites': lambda: Site.all(keys_only=True).filter('example =', False),
+}
+
+def _full_count(name):
+    return _total_queries[name]().count(None)
+
+def get_total(name):
+    '''
+    The running total, or a full count if it hasn't been reconciled yet.
+    '''
+    total = ShardedTotal.get_total(name)
+    if total is None:
+        total = _full_count(name)
+    return total
+
+def queue_reconcile_total(name):
+    taskqueue.add(url=url_for('tasks.reconcile_total'), params={'name': name})
+
+@tasks.route('/tasks/reconcile_total', methods=['POST'])
+@csrf_exempt
+def reconcile_total():
+    '''
+    Count what a sharded total counts, a batch of keys per task, and correct
+    the total by how far the shards were from the count when it started.
+    Creates and deletes during the count keep adding to the shards, so the
+    correction is made relative to the shards' sum then, not set outright.
+    '''
+    name = request.form.get('name', '')
+    if name not in _total_queries:
+        return 'UNKNOWN_TOTAL'
+    counted = int(request.form.get('counted', 0))
+    cursor = request.form.get('cursor', None)
+    if cursor:
+        snapshot = int(request.form['snapshot'])
+    else:
+        snapshot, reconciled = ShardedTotal.get_shards(name)
+        if reconciled:
+            return 'RECONCILED'
+    query = _total_queries[name]()
+    if cursor:
+        query.with_cursor(start_cursor=cursor)
+    batch_size = settings.sharded_totals['reconcile_batch_size']
+    keys = query.fetch(batch_size)
+    counted += len(keys)
+    if len(keys) == batch_size:
+        taskqueue.add(url=url_for('tasks.reconcile_total'), params={'name': name, 'counted': counted, 'cursor': query.cursor(), 'snapshot': snapshot})
+        return 'CONTINUED'
+    drift = counted - snapshot
+    if db.run_in_transaction(ShardedTotal.reconcile, name, drift):
+        logging.info('Corrected the %s total by %d', name, drift)
+    return 'DONE'
+
 @tasks.route('/tasks/stats')
 @csrf_exempt
 def stats_cron():
-    current_user_count = GqlQuery('SELECT __key__ FROM UserSettings').count(None)
-    current_site_count = GqlQuery('SELECT __key__ FROM Site WHERE example=false').count(None)
+    totals = dict((name, ShardedTotal.get_total(name)) for name in _total_queries)
+    current_user_count = totals['users'] if totals['users'] is not None else _full_count('users')
+    current_site_count = totals['sites'] if totals['sites'] is not None else _full_count('sites')
     now = datetime.now()
     saved_user_count = counter.load_and_get_count('user:all', period_type=PeriodType.DAY, period=now) or 0
     saved_site_count = counter.load_and_get_count('site:all', period_type=PeriodType.DAY, period=now) or 0
-    count_view('user:all', delta=(current_user_count - saved_user_count), batch_size=None, period=now)
-    count_view('site:all', delta=(current_site_count - saved_site_count), batch_size=None, period=now)
+    # Only once the totals are reconciled; until then their reconciles are queued below.
+    if totals['users'] is not None:
+        count_view('user:all', delta=(current_user_count - saved_user_count), batch_size=None, period=now, buffered=False)
+    if totals['sites'] is not None:
+        count_view('site:all', delta=(current_site_count - saved_site_count), batch_size=None, period=now, buffered=False)
+    persist_referrers()
+    for name, total in totals.items():
+        if total is None:
+            queue_reconcile_total(name)
     return render_template('_stats_cron.html', current_user_count=current_user_count, current_site_count=current_site_count, saved_user_count=saved_user_count, saved_site_count=saved_site_count)
 
+def _can_preview(page):
+    return settings.url2png['fake'] or not ('localhost' in page.url or '127.0.0.1' in page.url)
+
+def _shrink_preview(img):
+    '''
+    Scale a captured preview down to settings.url2png['bounds'] if it's
+    bigger, and recompress it. Returns whichever of the two is smaller.
+    '''
+    width, height = [int(n) for n in settings.url2png['bounds'].split('x')]
+    try:
+        image = images.Image(img)
+        if image.width <= width and image.height <= height:
+            return img
+        image.resize(width=width, height=height)
+        shrunk = image.execute_transforms(output_encoding=images.PNG)
+    except images.Error, e:
+        logging.warn('Could not shrink preview image: %s', e)
+        return img
+    return shrunk if len(shrunk) < len(img) else img
+
+def _store_preview(page, source, result, url):
+    if result.status_code == 200:
+        page.set_preview(_shrink_preview(result.content), source)
+        return True
+    msg = 'Error while fetching preview image from %s\nStatus %s\nHeaders\n%s\nFinal Url: "%s"' % (url, result.status_code, result.headers, getattr(result, 'final_url', ''))
+    logging.warn(msg)
+    return False
+
+@tasks.route('/tasks/fetch_previews', methods=['POST'])
+@csrf_exempt
+def fetch_previews():
+    '''
+    Capture the previews of a batch of the pages queued by Page.queue_preview
+    all at once, skipping pages whose url and published CSS haven't changed
+    since their current preview was captured.
+    '''
+    queue = taskqueue.Queue('preview-requests')
+    batch_size = settings.previews['batch_size']
+    leased = queue.lease_tasks(settings.previews['lease_seconds'], batch_size)
+    if not leased:
+        return 'OK'
+    pages = [page for page in db.get(list(set(task.payload for task in leased))) if page]
+    captures = []
+    for page in pages:
+        source = page.preview_source_for()
+        if source == page.preview_source or not _can_preview(page):
+            continue
+        url = 'http:' + url2png(page.url)
+        rpc = urlfetch.create_rpc(deadline=10)
+        urlfetch.make_fetch_call(rpc, url)
+        captures.append((page, source, url, rpc))
+    for page, source, url, rpc in captures:
+        try:
+            _store_preview(page, source, rpc.get_result(), url)
+        except urlfetch.Error, e:
+            # It'll be captured again the next time the page is queued.
+            logging.warn('Error while fetching preview image from %s: %s', url, e)
+    queue.delete_tasks(leased)
+    if len(leased) == batch_size:
+        taskqueue.add(queue_name='fetch-preview', url=url_for('tasks.fetch_previews'))
+    return 'CAPTURED %d of %d' % (len(captures), len(pages))
+
 @tasks.route('/tasks/fetch_preview', methods=['POST'])
 @csrf_exempt
 def fetch_preview():
+    # Single page tasks queued before batching; new ones go to fetch_previews.
     page = Page.get_or_404(request.form.get('page_key', ''))
-    if 'localhost' in page.url or '127.0.0.1' in page.url:
+    if not _can_preview(page):
         return 'OK'
     url = 'http:' + url2png(page.url)
     result = urlfetch.fetch(url, deadline=10)
-    if result.status_code == 200:
-        page.preview_img = result.content
-        page.put()
+    if _store_preview(page, page.preview_source_for(), result, url):
         return 'OK'
-    else:
-        msg = 'Error while fetching preview image from %s\nStatus %s\nHeaders\n%s\nFinal Url: "%s"' % (url, result.status_code, result.headers, getattr(result, 'final_url', ''))
-        logging.warn(msg)
-        return msg, 500
+    return 'Error while fetching preview image from %s' % url, 500
 
 def queue_import(page, first_time=False):
     if first_time:
@@ -63,87 +185,66 @@ def queue_import(page, first_time=False):
         params = {'page_key': page.key()},
     )
 
-def create_importer(page):
-    importer = Importer(page=page, style='')
-    resp = urlfetch.fetch(page.url, deadline=10)
-    if resp.status_code == 200:
-        soup = BeautifulSoup(resp.content)
-        parser = CSSParser()
-        for tag in soup.findAll(re.compile(r'^(link|style)$')):
-            if tag.name == 'link':
-                if tag.get('href', None) and tag.get('rel', 'stylesheet').lower() == 'stylesheet':
-                    url = urljoin(page.url, tag['href'])
-                    if urlparse(url).netloc != urlparse(request.url).netloc:
-                        importer.urls.append(url)
-            elif tag.name == 'style':
-                media = tag.get('media', None)
-                sheet = parser.parseString(''.join(tag.contents).strip('\n'), href=url)
-                style = sheet.cssText
-                if media:
-                    style = '@media %s {\n%s\n}' % (media, style)
-                style = '/* Imported directly from %s */\n%s\n' % (page.url, style)
-                importer.style += style
-        # Patch around AppEngine's frame inspection
-        del parser
-
-        importer.put()
-        queue_import(page)
+def _finish_import(page, importer, imported, errors):
+    page.import_state = IMPORT_DONE
+    style = page.styles[0]
+    if errors:
+        errors = 'Errors:\n%s\n\n' % ('\n'.join(errors))
+    else:
+        errors = ''
+    existing_rev = style.preview_rev if style.preview_rev else style.published_rev
+    rev = style.preview_rev
+    if not rev:
+        rev = StyleRevision(parent=style, rev=style.published_rev.rev + 1)
+    # The only write of the imported styles
+    rev.raw = '%s\n\n%s/* End of imported styles */\n\n%s' % (imported, errors, existing_rev.raw)
+    rev.put()
+    if not style.preview_rev:
+        style.preview_rev = rev
+        style.put()
+    page.put()
+    if importer:
+        importer.delete()
 
 @tasks.route('/tasks/import', methods=['POST'])
 @csrf_exempt
 def do_import():
+    '''
+    Import the styles of a page's site into its first style, all at once
+    unless there's too much to do before the task's deadline, in which case
+    the progress is saved in an Importer and the next task continues.
+    '''
+    deadline = time.time() + settings.importer['time_budget']
     page = Page.get(request.form.get('page_key', ''))
     if not page or page.import_state != IMPORTING:
         return 'NO_IMPORTER' # We're done
     importer = Importer.gql('WHERE page=:1', page.key()).get()
-    if not importer:
-        # This requires a request to fetch the page and parse the URLs.
-        # It also enqueues the next run.
-        create_importer(page)
-        return 'CREATED'
-    if importer.urls:
-        url = importer.urls.pop(0)
-        parser = None
-        try:
-            resp = urlfetch.fetch(url, deadline=10)
-            if resp.status_code == 200:
-                parser = CSSParser()
-                sheet = parser.parseString(resp.content, href=url)
-                style = sheet.cssText
-                importer.style += '\n\n/* Imported from %s */\n%s' % (url, style)
-            else:
-                raise Exception('Error fetching %s' % url)
-        except Exception, e:
-            import traceback
-            importer.errors.append('Error importing %s' % url)
-            logging.error('Error importing for Page %s from %s:\n%s\n%s', page.key().id(), url, e, traceback.format_exc())
-        finally:
-            # Patch around AppEngine's frame inspection
-            if parser:
-                del parser
-
+    if importer:
+        if importer.sources is None:
+            # Started before imports were done in batches
+            sources = [{'url': url, 'media': None, 'css': None} for url in importer.urls]
+        else:
+            sources = json.loads(importer.sources)
+        style, errors, size = importer.style or u'', list(importer.errors), importer.size or 0
+    else:
+        sources, errors = find_sources(page, urlparse(request.url).netloc)
+        style, size = u'', 0
+    imported, new_errors, sources, size = import_sources(sources, deadline, size)
+    style += imported
+    errors += new_errors
+    if sources:
+        if not importer:
+            importer = Importer(page=page)
+        importer.urls = []
+        importer.sources = json.dumps(sources)
+        importer.style = style
+        importer.errors = errors
+        importer.size = size
         importer.put()
         queue_import(page)
-        return 'IMPORTED'
-    else:
-        page.import_state = IMPORT_DONE
-        style = page.styles[0]
-        errors = ''
-        if importer.errors:
-            errors = 'Errors:\n%s\n\n' % ('\n'.join(importer.errors))
-        existing_rev = style.preview_rev if style.preview_rev else style.published_rev
-        existing_scss = existing_rev.raw
-        rev = style.preview_rev
-        if not rev:
-            rev = StyleRevision(parent=page.styles[0])
-            rev.put()
-            style.preview_rev = rev
-            style.put()
-        rev.raw = '%s\n\n%s/* End of imported styles */\n\n%s' % (importer.style, errors, existing_scss)
-        rev.put()
-        page.put()
-        importer.delete()
-        return 'DONE'
+        return 'CONTINUED'
+    _finish_import(page, importer, hoist_imports(style), errors)
+    return 'DONE'
 
 @tasks.route('/tasks/upload_style', methods=['GET', 'POST'])
 @csrf_exempt
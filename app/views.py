@@ -4,21 +4,22 @@ from datetime import datetime, timedelta
 from hashlib import sha1
 from base64 import b32encode
 from urlparse import urlparse
+from werkzeug import http_date, parse_date
 from flask import Response, Module, request, session, url_for, redirect, abort, flash, render_template, render_template_string, jsonify, make_response, send_from_directory
-from google.appengine.ext.db import GqlQuery, Blob, Link
-from google.appengine.api import channel as gae_channels
-from google.appengine.api import users, mail, memcache
+from google.appengine.ext.db import GqlQuery, Blob, Link, Key, get as db_get
+from google.appengine.api import users, mail, memcache, runtime
 from google.appengine.api.users import User
-from livecount.counter import PeriodType, LivecountCounter
+from livecount.counter import PeriodType
 from jsmin import jsmin
 from fogbugz import FogBugz
 import settings
 from extensions import context_processor
-from models import SchemaVersion, Style, StyleRevision, Site, Invitation, Page, PageChannel, UserSettings
-from tasks import queue_import
+from models import SchemaVersion, Style, StyleRevision, Site, Invitation, Page, PageChannel, PublishedBundle, UserSettings
+from tasks import queue_import, get_total
 from tasks import IMPORT_DONE, CAN_IMPORT
 from proxy import get_html, check_for_tags
-from count import count_view, get_period_and_count
+from count import count_view, count_referrer, flush_counts, get_period_and_count, top_referrers
+from compiler import compile_stats
 from forms import StyleForm, InviteForm, PageForm, SiteForm
 from decorators import requires_auth, requires_admin
 from docs import doc_list
@@ -45,14 +46,58 @@ def _etag(data):
     etag = sha1(data).hexdigest()
     return etag
 
-def _send_file(content, content_type, etag=None):
+def _not_modified(etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match', None)
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since.
+        etags = [tag.strip().strip('"') for tag in if_none_match.split(',')]
+        return etag in etags or '*' in etags
+    if last_modified:
+        modified_since = parse_date(request.headers.get('If-Modified-Since', None))
+        return modified_since is not None and last_modified <= modified_since
+    return False
+
+def _send_file(content, content_type, etag=None, headers=None, last_modified=None, cache_control=None):
     if not etag:
         etag = _etag(content)
-    if request.headers.get('If-None-Match', '') == etag:
-        return 'Not Modified', 304
-    headers = {'ETag': etag}
+    headers = dict(headers or {}, ETag=etag)
+    if last_modified:
+        last_modified = last_modified.replace(microsecond=0) # HTTP dates have a resolution of seconds
+        headers['Last-Modified'] = http_date(last_modified)
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    if _not_modified(etag, last_modified):
+        headers.pop('Content-Encoding', None)
+        return Response(status=304, headers=headers)
     return Response(content, headers=headers, content_type=content_type)
 
+def _css_cache_control(preview):
+    if preview:
+        return 'no-cache'
+    return 'public, max-age=%(max_age)d, stale-while-revalidate=%(stale_while_revalidate)d' % settings.css_cache_control
+
+def _accepts_gzip():
+    # An explicit gzip;q=0 beats a *
+    qualities = dict((encoding.lower(), quality) for encoding, quality in request.accept_encodings)
+    return qualities.get('gzip', qualities.get('*', 0)) > 0
+
+def _send_css_bundle(bundle, cache_control):
+    headers = {'Vary': 'Accept-Encoding'}
+    content = bundle.css
+    etag = bundle.etag
+    if _accepts_gzip():
+        headers['Content-Encoding'] = 'gzip'
+        content = bundle.gzipped
+        etag += '-gz' # the bodies differ, so their ETags must too
+    return _send_file(content, 'text/css', etag, headers, bundle.dt_last_modified, cache_control)
+
+def _redirect_to_css_version(page_key, bundle):
+    # The redirect is cached like the published CSS used to be, since the
+    # current version changes whenever the page is published.
+    response = redirect(url_for('css_version', page_key=page_key, version=bundle.version))
+    response.headers['Cache-Control'] = _css_cache_control(False)
+    return response
+
 def _create_example_site(user):
     site = Site(
         name='Example Site',
@@ -129,26 +174,26 @@ def css(page_key):
     if not preview and not pretty:
         count_view('css:all')
         if request.referrer:
-            count_view('css:page:%s:%s' % (urlparse(request.referrer).netloc, page_key))
-        etag = memcache.get(page_key + '-css-etag')
-        if etag and request.headers.get('If-None-Match', '') == etag:
-            return 'Not Modified', 304
-        css = memcache.get(page_key + '-css')
-        if not css or not etag:
-            page = Page.get_or_404(page_key)
-            css = page.compressed_css(False)
-            etag = _etag(css)
-            expires = 24 * 60 * 60
-            memcache.set(page_key + '-css-etag', etag, time=expires)
-            memcache.set(page_key + '-css', css, time=expires)
-        return _send_file(css, 'text/css', etag)
+            count_referrer(urlparse(request.referrer).netloc, page_key)
+        bundle = PublishedBundle.get_for_page(page_key)
+        if settings.css_versioned_urls:
+            return _redirect_to_css_version(page_key, bundle)
+        return _send_css_bundle(bundle, _css_cache_control(False))
     else:
         page = Page.get_or_404(page_key)
         if pretty:
             css = page.uncompressed_css(preview)
         else:
             css = page.compressed_css(preview)
-        return _send_file(css, 'text/css')
+        return _send_file(css, 'text/css', None, {'Vary': 'Accept-Encoding'}, page.last_modified(preview), _css_cache_control(preview))
+
+@views.route('/css/<page_key>/<version>.css')
+def css_version(page_key, version):
+    bundle = PublishedBundle.get_for_page(page_key)
+    if version != bundle.version:
+        # Only the current version is kept, so send old urls on to it.
+        return _redirect_to_css_version(page_key, bundle)
+    return _send_css_bundle(bundle, 'public, max-age=%d, immutable' % settings.css_cache_control['versioned_max_age'])
 
 @views.route('/js/<file_name>.js')
 @views.route('/js/<page_key>/<file_name>.js')
@@ -371,21 +416,26 @@ def edit_page(page_id):
 @requires_auth
 def editor(page_id):
     page = Page.get_edit_or_404(page_id)
-    user = users.get_current_user()
-    client_id = 'page-%d-%s-%s' % (page_id, user.user_id(), b32encode(os.urandom(10)))
-    token = gae_channels.create_channel(client_id)
-    channel = PageChannel(user=user, page=page, token=token, client_id=client_id)
-    channel.put()
-    return render_template('editor.html', page=page, channel_token=token)
+    channel = PageChannel.new_channel(page, users.get_current_user())
+    return render_template('editor.html', page=page, channel_token=channel.token)
 
 @views.route('/page/<int:page_id>/preview')
 @requires_auth
 def page_preview(page_id):
     page = Page.get_edit_or_404(page_id)
-    if page.preview_img:
-        return _send_file(page.preview_img, 'image/png')
+    if not page.preview_digest:
+        return redirect('/static/img/loading-preview.png')
+    if request.args.get('v') == page.preview_version:
+        cache_control = 'private, max-age=%d' % settings.preview_max_age
     else:
+        cache_control = 'private, no-cache'
+    if _not_modified(page.preview_digest, None):
+        # Don't even load the image
+        return Response(status=304, headers={'ETag': page.preview_digest, 'Cache-Control': cache_control})
+    preview = page.get_preview()
+    if not preview:
         return redirect('/static/img/loading-preview.png')
+    return _send_file(preview.img, 'image/png', preview.digest, cache_control=cache_control)
 
 @views.route('/page/<int:page_id>/import', methods=['GET', 'POST'])
 @requires_auth
@@ -437,7 +487,15 @@ def page_styles(page_id):
 def delete_style():
     style_id = int(request.form.get('style_id', -1))
     style = Style.get_admin_or_404(style_id)
+    pages = Page.gql('WHERE _styles=:1', style.key()).fetch(1000)
+    for page in pages:
+        page.styles = [s for s in page.styles if s and s.key() != style.key()]
+        page.put()
     style.delete()
+    for page in pages:
+        # The published CSS no longer includes the style
+        PublishedBundle.publish(page)
+        page.queue_refresh()
     return 'OK'
 
 @views.route('/guider/saw', methods=['POST'])
@@ -451,12 +509,12 @@ def saw_guider():
 @views.route('/example/4/<page_key>')
 def example4(page_key):
     page = Page.get_or_404(page_key)
-    return render_template('examples/blog-html4.html', page=page)
+    return render_template('examples/blog-html4.html', page=page, css_version=PublishedBundle.get_for_page(page).version)
 
 @views.route('/example/5/<page_key>')
 def example5(page_key):
     page = Page.get_or_404(page_key)
-    return render_template('examples/blog-html5.html', page=page)
+    return render_template('examples/blog-html5.html', page=page, css_version=PublishedBundle.get_for_page(page).version)
 
 @views.route('/settings/locale', methods=['GET', 'POST'])
 def set_locale():
@@ -512,8 +570,8 @@ def _stats():
     if not (users.is_current_user_admin() or users.get_current_user().email().endswith('@fogcreek.com') or request.remote_addr in ['127.0.0.1', '71.190.247.30']):
         abort(404)
 
-    user_count = GqlQuery('SELECT __key__ FROM UserSettings').count(None)
-    site_count = GqlQuery('SELECT __key__ FROM Site WHERE example=false').count(None)
+    user_count = get_total('users')
+    site_count = get_total('sites')
     now = datetime.now()
     days = list(reversed([now-timedelta(days) for days in range(14)]))
     day_views = [get_period_and_count('css:all', PeriodType.DAY, day) for day in days]
@@ -524,30 +582,42 @@ def _stats():
     day_sites[-1] = day_sites[-1][0], site_count
 
     # get the top referrers
-    period_type = PeriodType.DAY
-    fetch_limit = 50
-    query = LivecountCounter.all().order('-count')
-    query.filter('period_type = ', period_type)
-    query.filter('period = ', PeriodType.find_scope(period_type, datetime.now()))
-    top_counters = query.fetch(fetch_limit)
-    top_referrers = []
-    for counter in top_counters:
-        name = counter.name
-        if name.startswith('css:page') and not name.startswith('css:page:www.webputty.net'):
-            parts = name.split(':')
-            page = None
-            preview_size = 0
-            published_size = 0
+    referrers = []
+    page_keys = set()
+    for netloc, page_key, count in top_referrers(now, 50):
+        if netloc != 'www.webputty.net':
+            referrers.append((netloc, count, page_key))
             try:
-                page = Page.get(parts[3])
+                key = Key(page_key)
             except Exception:
-                logging.warn("_stats counldn't find matching page: %s", parts[3])
-            if page:
-                preview_size = len(page.compressed_css(True))
-                published_size = len(page.compressed_css(False))
-            top_referrers.append((parts[2], counter.count, parts[3], preview_size, published_size))
+                continue
+            if key.kind() == 'Page':
+                page_keys.add(key)
+    page_keys = list(page_keys)
+    pages = dict((str(key), page) for key, page in zip(page_keys, db_get(page_keys)) if page)
+    Page.prefetch_styles(pages.values())
+    referrer_sizes = []
+    for referrer, count, page_key in referrers:
+        page = pages.get(page_key)
+        preview_stats = published_stats = dict(size=0, gzip_size=None, rule_count=None, compile_ms=None)
+        if page:
+            preview_stats = page.css_stats(True)
+            published_stats = page.css_stats(False)
+        else:
+            logging.warn("_stats counldn't find matching page: %s", page_key)
+        referrer_sizes.append((referrer, count, page_key, preview_stats, published_stats))
 
-    return render_template('_stats.html', user_count=user_count, site_count=site_count, day_views=day_views, day_users=day_users, day_sites=day_sites, top_referrers=top_referrers)
+    return render_template('_stats.html', user_count=user_count, site_count=site_count, day_views=day_views, day_users=day_users, day_sites=day_sites, top_referrers=referrer_sizes, compile_stats=compile_stats())
+
+@views.route('/_fake_url2png/<bounds>/<path:url>')
+def fake_url2png(bounds, url):
+    """
+    Stands in for url2png when settings.url2png['fake'] is on, so previews
+    can be captured without calling out to it (in tests and locally).
+    """
+    if not settings.url2png['fake']:
+        abort(404)
+    return send_from_directory(os.path.join(os.path.dirname(__file__), '../static/img'), 'loading-preview.png')
 
 @views.route('/robots.txt')
 def robotstxt():
@@ -558,6 +628,16 @@ def _warmup():
     """
     Do any warmup necessary, such as priming caches.
     """
+    # Backends get told when they're shutting down; don't lose buffered counts then.
+    runtime.set_shutdown_hook(lambda *args: flush_counts())
+    return 'OK'
+
+@views.route('/_ah/stop')
+def _stop():
+    """
+    Sent to manually scaled instances before they're shut down.
+    """
+    flush_counts()
     return 'OK'
 
 @views.route('/<path:file>.gif')
@@ -10,9 +10,75 @@ from cssproductions import *
 from helper import normalize
 import itertools
 import re
+import sre_constants
+import sre_parse
 
 _TOKENIZER_CACHE = {}
 
+_ASCII = frozenset(unichr(i) for i in range(128))
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: r'\d',
+    sre_constants.CATEGORY_NOT_DIGIT: r'\D',
+    sre_constants.CATEGORY_SPACE: r'\s',
+    sre_constants.CATEGORY_NOT_SPACE: r'\S',
+    sre_constants.CATEGORY_WORD: r'\w',
+    sre_constants.CATEGORY_NOT_WORD: r'\W',
+    }
+
+def _first_in(items):
+    """ASCII chars matched by the items of a parsed character class"""
+    chars = set()
+    negate = False
+    for op, av in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            chars.add(unichr(av))
+        elif op == sre_constants.RANGE:
+            chars.update(c for c in _ASCII if av[0] <= ord(c) <= av[1])
+        elif op == sre_constants.CATEGORY and av in _CATEGORIES:
+            match = re.compile(_CATEGORIES[av], re.U).match
+            chars.update(c for c in _ASCII if match(c))
+        else:
+            return _ASCII
+    if negate:
+        return _ASCII - chars
+    return chars
+
+def _first(parsed):
+    """
+    (chars, nullable) of a parsed regex: the ASCII chars a match may start
+    with, and whether it may match the empty string. Anything not understood
+    may start with any char, so this errs on the side of too many chars.
+    """
+    chars = set()
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            first, nullable = set([unichr(av)]) & _ASCII, False
+        elif op == sre_constants.NOT_LITERAL or op == sre_constants.ANY:
+            first, nullable = _ASCII, False
+        elif op == sre_constants.IN:
+            first, nullable = _first_in(av), False
+        elif op == sre_constants.AT:
+            first, nullable = set(), True
+        elif op == sre_constants.BRANCH:
+            first, nullable = set(), False
+            for branch in av[1]:
+                branch_first, branch_nullable = _first(branch)
+                first |= branch_first
+                nullable = nullable or branch_nullable
+        elif op == sre_constants.SUBPATTERN:
+            first, nullable = _first(av[-1])
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            first, nullable = _first(av[2])
+            nullable = nullable or av[0] == 0
+        else:
+            return _ASCII, True
+        chars |= first
+        if not nullable:
+            return chars, False
+    return chars, True
+
 class Tokenizer(object):
     """
     generates a list of Token tuples:
@@ -30,10 +96,16 @@ class Tokenizer(object):
     unicodesub = re.compile(r'\\[0-9a-fA-F]{1,6}(?:\r\n|[\t|\r|\n|\f|\x20])?').sub
     cleanstring = re.compile(r'\\((\r\n)|[\n|\r|\f])').sub
 
-    def __init__(self, macros=None, productions=None, doComments=True):
+    def __init__(self, macros=None, productions=None, doComments=True,
+                 dispatch=True):
         """
         inits tokenizer with given macros and productions which default to
         cssutils own macros and productions
+
+        dispatch
+            if ``True`` only tries the productions which may start with the
+            next char (if it is ASCII) instead of all of them, see
+            ``_dispatch_productions``; the tokens are the same either way
         """
         if isinstance(macros, dict):
             macros_hash_key = sorted(macros.items()) 
@@ -41,19 +113,21 @@ class Tokenizer(object):
             macros_hash_key = macros
         hash_key = str((macros_hash_key, productions))
         if hash_key in _TOKENIZER_CACHE:
-            (tokenmatches, commentmatcher, urimatcher) = _TOKENIZER_CACHE[hash_key]
+            (tokenmatches, commentmatcher, urimatcher, dispatchmatches) = _TOKENIZER_CACHE[hash_key]
         else:
             if not macros:
                 macros = MACROS
             if not productions:
                 productions = PRODUCTIONS
-            tokenmatches = self._compile_productions(self._expand_macros(macros,
-                                                                         productions))
+            expanded = self._expand_macros(macros, productions)
+            tokenmatches = self._compile_productions(expanded)
             commentmatcher = [x[1] for x in tokenmatches if x[0] == 'COMMENT'][0]
             urimatcher = [x[1] for x in tokenmatches if x[0] == 'URI'][0]
-            _TOKENIZER_CACHE[hash_key] = (tokenmatches, commentmatcher, urimatcher)
+            dispatchmatches = self._dispatch_productions(expanded, tokenmatches)
+            _TOKENIZER_CACHE[hash_key] = (tokenmatches, commentmatcher, urimatcher, dispatchmatches)
 
         self.tokenmatches = tokenmatches
+        self.dispatchmatches = dispatchmatches if dispatch else {}
         self.commentmatcher = commentmatcher
         self.urimatcher = urimatcher
         
@@ -73,12 +147,31 @@ class Tokenizer(object):
         return expanded
 
     def _compile_productions(self, expanded_productions):
-        """compile productions into callable match objects, order is kept"""
+        """compile productions into callable match objects, order is kept;
+        they match at the start of the text or at the given pos in it"""
         compiled = []
         for key, value in expanded_productions:
-            compiled.append((key, re.compile('^(?:%s)' % value, re.U).match))
+            compiled.append((key, re.compile('(?:%s)' % value, re.U).match))
         return compiled
 
+    def _dispatch_productions(self, expanded_productions, compiled):
+        """
+        returns a dict of each ASCII char to the compiled productions (but
+        BOM), in order, which may match text starting with that char
+        """
+        firsts = []
+        for key, value in expanded_productions[1:]:
+            try:
+                chars, nullable = _first(sre_parse.parse(value, re.U))
+            except (sre_constants.error, ValueError):
+                chars, nullable = _ASCII, True
+            firsts.append(_ASCII if nullable else chars)
+        dispatch = {}
+        for c in _ASCII:
+            dispatch[c] = [production for production, chars
+                           in zip(compiled[1:], firsts) if c in chars]
+        return dispatch
+
     def push(self, *tokens):
         """Push back tokens which have been pulled but not processed."""
         self._pushed = itertools.chain(tokens, self._pushed)
@@ -132,38 +225,42 @@ class Tokenizer(object):
             text = text[len(found):]
             col += len(found)
         
-        while text:
+        # the rest is matched in place from pos, copying the remaining text
+        # for each token took longer than anything else
+        pos, textlen = 0, len(text)
+        while pos < textlen:
             # do pushed tokens before new ones 
             for pushed in self._pushed:
                 yield pushed
 
             # speed test for most used CHARs, sadly . not possible :(
-            c = text[0]
+            c = text[pos]
             if c in u',:;{}>+[]':
                 yield ('CHAR', c, line, col)
                 col += 1
-                text = text[1:]
+                pos += 1
                 
             else:
-                # check all other productions, at least CHAR must match
-                for name, matcher in productions:
+                # check all other productions which may start with c, at 
+                # least CHAR must match
+                for name, matcher in self.dispatchmatches.get(c, productions):
                     
                     # TODO: USE bad comment? 
-                    if fullsheet and name == 'CHAR' and text.startswith(u'/*'):
+                    if fullsheet and name == 'CHAR' and text.startswith(u'/*', pos):
                         # before CHAR production test for incomplete comment
-                        possiblecomment = u'%s*/' % text
+                        possiblecomment = u'%s*/' % text[pos:]
                         match = self.commentmatcher(possiblecomment)
                         if match and self._doComments:
                             yield ('COMMENT', possiblecomment, line, col)
-                            text = None # ate all remaining text 
+                            pos = textlen # ate all remaining text 
                             break 
     
-                    match = matcher(text) # if no match try next production
+                    match = matcher(text, pos) # if no match try next production
                     if match:
                         found = match.group(0) # needed later for line/col
                         if fullsheet:                        
                             # check if found may be completed into a full token
-                            if 'INVALID' == name and text == found:
+                            if 'INVALID' == name and match.end() == textlen:
                                 # complete INVALID to STRING with start char " or '
                                 name, found = 'STRING', '%s%s' % (found, found[0])
                             
@@ -172,7 +269,7 @@ class Tokenizer(object):
                                 # url( is a FUNCTION if incomplete sheet
                                 # FUNCTION production MUST BE after URI production
                                 for end in (u"')", u'")', u')'):
-                                    possibleuri = '%s%s' % (text, end)
+                                    possibleuri = '%s%s' % (text[pos:], end)
                                     match = self.urimatcher(possibleuri)
                                     if match:
                                         name, found = 'URI', match.group(0)
@@ -195,7 +292,7 @@ class Tokenizer(object):
                                     name = self._atkeywords[_normalize(found)]
                                 except KeyError, e:
                                     # might also be misplace @charset...
-                                    if '@charset' == found and u' ' == text[len(found):len(found)+1]:
+                                    if '@charset' == found and u' ' == text[pos+len(found):pos+len(found)+1]:
                                         # @charset needs tailing S!
                                         name = CSSProductions.CHARSET_SYM
                                         found += u' '
@@ -208,7 +305,7 @@ class Tokenizer(object):
                                                 name != 'COMMENT'):
                             yield (name, value, line, col)
                         
-                        text = text[len(found):]
+                        pos += len(found)
                         nls = found.count(self._linesep)
                         line += nls
                         if nls:
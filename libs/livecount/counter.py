@@ -33,6 +33,18 @@ from google.appengine.ext import webapp
    - Read-Through
 """
 
+# In batch writeback mode, dirty counters are recorded in a memcache-backed set (numbered
+# slots) that a single worker task drains, writing up to WRITEBACK_BATCH_SIZE counters
+# with one datastore put per run. Otherwise, or when memcache can't record a slot, each
+# dirty counter gets its own writeback task.
+BATCH_WRITEBACKS = True
+WRITEBACK_BATCH_SIZE = 100
+WRITEBACK_DELAY = 10 # seconds a drain waits, to gather more dirty counters
+DIRTY_TIMEOUT = 10 * 60 # a dirty counter whose slot was lost gets written back again after this
+DIRTY_SET_NAMESPACE = 'livecount-dirty'
+EMPTY_SLOT_RETRIES = 3 # times a drain waits for a slot below 'index' that hasn't been written yet
+EMPTY_SLOT_DELAY = 1 # seconds between those waits
+
 class PeriodType(object):
     SECOND = "second"
     MINUTE = "minute"
@@ -145,9 +157,54 @@ def load_and_increment_counter(name, period=datetime.now(), period_types=[Period
             
         # If batch_size is set, only try creating one worker per batch
         if not batch_size or (batch_size and current_count % batch_size == 0):
-            if memcache.add(partial_key + '_dirty', delta, namespace=namespace):
-                #logging.info("Adding task to taskqueue. counter value = " + str(memcache.get(partial_key, namespace=namespace)))
-                taskqueue.add(queue_name='livecount-writebacks', url='/livecount/worker', params={'name': name, 'period': period, 'period_type': period_type, 'namespace': namespace}) # post parameter
+            queue_writeback(name, period, period_type, namespace, delta)
+
+
+def queue_writeback(name, period, period_type, namespace, delta):
+    """
+    Have the counter written back to the datastore, unless that's already pending.
+    """
+    partial_key = LivecountCounter.PartialKeyName(period_type, period, name)
+    if BATCH_WRITEBACKS:
+        if not memcache.add(partial_key + '_dirty', delta, time=DIRTY_TIMEOUT, namespace=namespace):
+            return
+        slot = memcache.incr('index', initial_value=0, namespace=DIRTY_SET_NAMESPACE)
+        if slot is not None and memcache.set('slot_%d' % slot, (name, str(period), period_type, namespace), namespace=DIRTY_SET_NAMESPACE):
+            schedule_batch_writeback()
+            return
+        logging.warn('queue_writeback: could not mark %s dirty, using a task of its own', partial_key)
+    elif not memcache.add(partial_key + '_dirty', delta, namespace=namespace):
+        return
+    #logging.info("Adding task to taskqueue. counter value = " + str(memcache.get(partial_key, namespace=namespace)))
+    taskqueue.add(queue_name='livecount-writebacks', url='/livecount/worker', params={'name': name, 'period': period, 'period_type': period_type, 'namespace': namespace}) # post parameter
+
+
+def schedule_batch_writeback(countdown=WRITEBACK_DELAY):
+    """
+    Start a worker to drain the dirty set, unless one is already scheduled or running.
+    """
+    if memcache.add('scheduled', 1, time=countdown + DIRTY_TIMEOUT, namespace=DIRTY_SET_NAMESPACE):
+        taskqueue.add(queue_name='livecount-writebacks', url='/livecount/batch_worker', countdown=countdown)
+
+
+def load_and_increment_counters(deltas, namespace='default', batch_size=None):
+    """
+    Increment many counters at once. deltas maps (name, period_type, period) to the amount to add.
+    Counters already in memcache are updated with a single offset_multi; the others are loaded
+    through load_and_increment_counter. With batch_size set, a worker is created for each counter
+    that crossed a multiple of batch_size.
+    """
+    counters = {}
+    for (name, period_type, period), delta in deltas.items():
+        partial_key = LivecountCounter.PartialKeyName(period_type, period, name)
+        counters[partial_key] = (name, period_type, period, delta)
+    results = memcache.offset_multi(dict((key, c[3]) for key, c in counters.items()), namespace=namespace)
+    for partial_key, (name, period_type, period, delta) in counters.items():
+        current_count = results.get(partial_key)
+        if current_count is None:
+            load_and_increment_counter(name, period, [period_type], namespace, delta, batch_size)
+        elif not batch_size or (current_count - delta) // batch_size != current_count // batch_size:
+            queue_writeback(name, period, period_type, namespace, delta)
 
 
 def load_and_decrement_counter(name, period=datetime.now(), period_types=[PeriodType.ALL], namespace='default', delta=1, batch_size=None):
@@ -180,6 +237,69 @@ class LivecountCounterWorker(webapp.RequestHandler):
         LivecountCounter(key_name=full_key, namespace=namespace, period_type=period_type, period=scoped_period, name=name, count=cached_count).put()
 
 
+class LivecountBatchWorker(webapp.RequestHandler):
+    """
+    Writes back the next WRITEBACK_BATCH_SIZE dirty counters, and continues with another
+    task if there are more.
+    """
+    def post(self):
+        index = memcache.get('index', namespace=DIRTY_SET_NAMESPACE) or 0
+        cursor = self.request.get('cursor') or memcache.get('cursor', namespace=DIRTY_SET_NAMESPACE)
+        if cursor is None:
+            # Lost track; anything older was marked dirty long ago and will be again.
+            cursor = max(0, index - 10 * WRITEBACK_BATCH_SIZE)
+        cursor = int(cursor)
+        end = min(index, cursor + WRITEBACK_BATCH_SIZE)
+
+        slot_keys = ['slot_%d' % slot for slot in range(cursor + 1, end + 1)]
+        dirty = memcache.get_multi(slot_keys, namespace=DIRTY_SET_NAMESPACE) if slot_keys else {}
+        # 'index' is incremented before the slot is written, so an empty slot may
+        # just not be written yet: stop short of it and look again in a moment.
+        # One that stays empty was evicted; its counter is marked dirty again
+        # once its flag expires.
+        retries = int(self.request.get('retries') or 0)
+        waiting = False
+        empty = [slot for slot in range(cursor + 1, end + 1) if 'slot_%d' % slot not in dirty]
+        if empty and retries < EMPTY_SLOT_RETRIES:
+            waiting = True
+            end = empty[0] - 1
+            slot_keys = slot_keys[:end - cursor]
+        elif empty:
+            logging.warn('LivecountBatchWorker: skipping %d empty slots', len(empty))
+        by_namespace = {}
+        for name, period, period_type, namespace in [dirty[key] for key in slot_keys if key in dirty]:
+            by_namespace.setdefault(namespace, []).append((name, period, period_type))
+
+        records = []
+        for namespace, counters in by_namespace.items():
+            partial_keys = [LivecountCounter.PartialKeyName(period_type, period, name) for name, period, period_type in counters]
+            memcache.delete_multi([partial_key + '_dirty' for partial_key in partial_keys], namespace=namespace)
+            cached_counts = memcache.get_multi(partial_keys, namespace=namespace)
+            for partial_key, (name, period, period_type) in zip(partial_keys, counters):
+                cached_count = cached_counts.get(partial_key)
+                if cached_count is None:
+                    logging.error('LivecountBatchWorker: Failure for partial key=%s', partial_key)
+                    continue
+                full_key = LivecountCounter.KeyName(namespace, period_type, period, name)
+                scoped_period = PeriodType.find_scope(period_type, period)
+                records.append(LivecountCounter(key_name=full_key, namespace=namespace, period_type=period_type, period=scoped_period, name=name, count=cached_count))
+        if records:
+            db.put(records)
+
+        memcache.set('cursor', end, namespace=DIRTY_SET_NAMESPACE)
+        if slot_keys:
+            memcache.delete_multi(slot_keys, namespace=DIRTY_SET_NAMESPACE)
+        if waiting:
+            taskqueue.add(queue_name='livecount-writebacks', url='/livecount/batch_worker', params={'cursor': end, 'retries': (retries + 1) if end == cursor else 0}, countdown=EMPTY_SLOT_DELAY)
+        elif end < index:
+            taskqueue.add(queue_name='livecount-writebacks', url='/livecount/batch_worker', params={'cursor': end})
+        else:
+            memcache.delete('scheduled', namespace=DIRTY_SET_NAMESPACE)
+            # Counters marked dirty while we were finishing up
+            if (memcache.get('index', namespace=DIRTY_SET_NAMESPACE) or 0) > end:
+                schedule_batch_writeback()
+
+
 class WritebackAllCountersHandler(webapp.RequestHandler):
     """
     Writes back all counters from memory to the datastore
@@ -217,6 +337,7 @@ class RedirectToCounterAdminHandler(webapp.RequestHandler):
 logging.getLogger().setLevel(logging.DEBUG)
 application = webapp.WSGIApplication([
     ('/livecount/worker', LivecountCounterWorker),
+    ('/livecount/batch_worker', LivecountBatchWorker),
     ('/livecount/writeback_all_counters', WritebackAllCountersHandler),
     ('/livecount/clear_entire_cache', ClearEntireCacheHandler),
     ('/', RedirectToCounterAdminHandler)
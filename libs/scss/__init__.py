@@ -71,10 +71,72 @@ import re
 import sys
 import time
 import textwrap
-from collections import deque
+import threading
+from collections import deque, OrderedDict
 
 profiling = {}
 
+# Process-wide cache of @import-ed files, already run through load_string().
+# Entries are keyed by the import name and the paths it was resolved against,
+# and are validated against the file's mtime before being used:
+_import_cache = {}
+
+def _get_mtime(filename):
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+# Process-wide LRU cache used by Scss.IncrementalCompilation(), mapping a hash
+# of a top-level block (and of everything it could depend on) to the block's
+# compiled CSS and the log records emitted while compiling it:
+BLOCK_CACHE_SIZE = 5000
+_block_cache = OrderedDict()
+_block_cache_lock = threading.Lock()
+
+# Process-wide caches of located blocks (see Scss.located_blocks) and of the
+# parsed arguments of @include calls (see Scss._do_include), both cleared when
+# they grow past their size. Only code strings up to BLOCKS_CACHE_MAX_LEN
+# characters long get their blocks cached, unless they are mixins or functions:
+BLOCKS_CACHE_SIZE = 10000
+BLOCKS_CACHE_MAX_LEN = 4096
+_blocks_cache = {}
+INCLUDE_CACHE_SIZE = 10000
+_include_cache = {}
+
+class _HiddenVars(object):
+    """
+    Read-only view of a context without some of its variables (as used by
+    Scss.apply_vars), to avoid copying the whole context just to hide them.
+    """
+    def __init__(self, context, hidden):
+        self.context = context
+        self.hidden = hidden
+
+    def __contains__(self, key):
+        return key not in self.hidden and key in self.context
+
+    def __getitem__(self, key):
+        if key in self.hidden:
+            raise KeyError(key)
+        return self.context[key]
+
+class _LogCapture(logging.Filter):
+    """
+    Holds back the records logged from the current thread so they can be
+    cached along with the output that produced them, or thrown away.
+    """
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.thread = threading.current_thread().ident
+        self.records = []
+
+    def filter(self, record):
+        if record.thread != self.thread:
+            return 1
+        self.records.append(record)
+        return 0
+
 # units and conversions
 _units = ['em', 'ex', 'px', 'cm', 'mm', 'in', 'pt', 'pc', 'deg', 'rad'
           'grad', 'ms', 's', 'hz', 'khz', '%']
@@ -462,6 +524,24 @@ def depar(str):
         str = str[1:-1]
     return str
 
+_top_level_directives = set(['@warn', '@print', '@raw', '@debug', '@option', '@import', '@extend', '@mixin', '@function', '@return', '@include', '@if', '@else', '@for', '@each', '@variables', '@vars'])
+def _utf8(str):
+    if isinstance(str, unicode):
+        return str.encode('utf-8')
+    return str
+
+def _is_top_level_block(c_property, c_codestr):
+    """
+    Tells if a top-level item is a block of rules that can be compiled on its
+    own (anything nested, @media, @font-face, etc.) rather than something that
+    changes the environment of the blocks that follow.
+    """
+    if c_codestr is None or c_property.startswith(('+', '=', '@prototype ')) or c_property.endswith(':'):
+        return False
+    if c_property.startswith('@'):
+        return c_property.split(None, 1)[0].lower() not in _top_level_directives
+    return True
+
 class Scss(object):
     # configuration:
     construct = 'self'
@@ -615,6 +695,22 @@ class Scss(object):
             if _property:
                 yield _property, None
 
+    def located_blocks(self, codestr, always=False):
+        """
+        Memoized tuple(self.locate_blocks(codestr)). Code that doesn't look
+        properly closed is never memoized, so its errors get logged every time.
+        """
+        try:
+            return _blocks_cache[codestr]
+        except KeyError:
+            pass
+        blocks = tuple(self.locate_blocks(codestr))
+        if (always or len(codestr) <= BLOCKS_CACHE_MAX_LEN) and codestr.count('{') == codestr.count('}'):
+            if len(_blocks_cache) >= BLOCKS_CACHE_SIZE:
+                _blocks_cache.clear()
+            _blocks_cache[codestr] = blocks
+        return blocks
+
     def normalize_selectors(self, _selectors, extra_selectors=None, extra_parents=None):
         """
         Normalizes or extends selectors in a string.
@@ -664,18 +760,21 @@ class Scss(object):
                         break
                     cont = _cont
             else:
-                # Flatten the context (no variables mapping to variables)
-                flat_context = {}
-                for k, v in context.items():
+                # Flatten the variables (no variables mapping to variables),
+                # only for the ones actually used:
+                def _flat_get(k):
+                    if k not in context:
+                        return None
+                    v = context[k]
                     while v in context:
                         _v = context[v]
                         if _v == v:
                             break
                         v = _v
-                    flat_context[k] = v
+                    return v
                 # Interpolate variables:
                 def _av(m):
-                    v = flat_context.get(m.group(2))
+                    v = _flat_get(m.group(2))
                     if v:
                         v = to_str(v)
                         if _dequote and m.group(1):
@@ -733,6 +832,105 @@ class Scss(object):
         return final_cont
     compile = Compilation
 
+    @print_timing(2)
+    def IncrementalCompilation(self, input_scss):
+        """
+        Same output as Compilation(input_scss), but the compiled output of each
+        top-level block is cached (see _block_cache) under a hash of the block
+        and of all the variables, mixins, functions, imports and options that
+        precede it; blocks that didn't change since the last time the sheet was
+        compiled are not compiled again.
+        Falls back to a full Compilation() when blocks can affect each other
+        (@extend, also when it comes from an imported mixin) or when anything
+        other than the blocks produces CSS.
+        """
+        self.reset()
+
+        codestr = self.load_string(input_scss)
+        if '@extend' in codestr or ' extends ' in codestr:
+            return self.Compilation(input_scss)
+
+        rule = spawn_rule(fileid='string', codestr=codestr, context=self._scss_vars, options=self._scss_opts, file='string')
+        p_selectors, p_parents = [''], set()
+        env = hashlib.sha1(repr(sorted(self._scss_vars.items())) + repr(sorted(self._scss_opts.items())))
+
+        fallback = False
+        capture = _LogCapture()
+        log.addFilter(capture)
+        try:
+            final_cont = ''
+            for c_property, c_codestr in self.locate_blocks(codestr):
+                if _is_top_level_block(c_property, c_codestr):
+                    key = env.copy()
+                    key.update(_utf8(c_property) + '{' + _utf8(c_codestr))
+                    key = key.hexdigest()
+                    with _block_cache_lock:
+                        cached = _block_cache.pop(key, None)
+                        if cached is not None:
+                            _block_cache[key] = cached # move to the most recently used end
+                    if cached is None:
+                        start = len(capture.records)
+                        cached = (self._compile_block(rule, c_property, c_codestr), capture.records[start:])
+                        with _block_cache_lock:
+                            _block_cache[key] = cached
+                            while len(_block_cache) > BLOCK_CACHE_SIZE:
+                                _block_cache.popitem(last=False)
+                    else:
+                        capture.records.extend(cached[1])
+                    if cached[0] is None:
+                        # The block extends (see _compile_block)
+                        fallback = True
+                        break
+                    final_cont += cached[0]
+                else:
+                    # Variables, mixins, functions, imports and options are
+                    # settled on the top-level rule, just like Compilation()
+                    # would, and become part of the environment hash:
+                    children = deque()
+                    properties = len(rule[PROPERTIES])
+                    stop = self.manage_child(rule, p_selectors, p_parents, children, None, None, c_property, c_codestr)
+                    if children or p_parents or len(rule[PROPERTIES]) != properties:
+                        fallback = True
+                        break
+                    env.update(_utf8(c_property) + '{' + _utf8(c_codestr or '') + '}')
+                    if stop:
+                        break
+        finally:
+            log.removeFilter(capture)
+        if fallback:
+            # Whatever was logged so far will be logged again by Compilation()
+            return self.Compilation(input_scss)
+        for record in capture.records:
+            log.handle(record)
+
+        if final_cont:
+            final_cont += '\n'
+        final_cont = self.post_process(final_cont)
+
+        return final_cont
+    compile_incremental = IncrementalCompilation
+
+    def _compile_block(self, rule, c_property, c_codestr):
+        """
+        Compiles a single top-level block of `rule` as Compilation() would,
+        or returns None if, once expanded, it extends any selector (the
+        parent could be in any other block)
+        """
+        children = deque()
+        self.manage_child(rule, [''], set(), children, None, None, c_property, c_codestr)
+        self.clean()
+        self.children.extendleft(children)
+        self.parse_children()
+        if any(' extends ' in selectors for selectors in self.parts):
+            self.clean()
+            return None
+        self.parse_extends()
+        self.manage_order()
+        self.parse_properties()
+        block_cont = self.create_css('string')
+        self.clean()
+        return block_cont[:-1] # create_css() always ends with an extra new line
+
     def load_string(self, str):
         # protects content: "..." strings
 
@@ -800,89 +998,103 @@ class Scss(object):
             #for r in [rule]+list(self.children)[:5]: print >>sys.stderr, repr(r[POSITION]), repr(r[SELECTORS]), repr(r[CODESTR][:80]+('...' if len(r[CODESTR])>80 else '')), dict((k, v) for k, v in r[CONTEXT].items() if k.startswith('$') and not k.startswith('$__')), dict(r[PROPERTIES]).keys()
 
     @print_timing(4)
-    def manage_children(self, rule, p_selectors, p_parents, p_children, scope, media):
-        for c_property, c_codestr in self.locate_blocks(rule[CODESTR]):
-            # Rules preprocessing...
-            if c_property.startswith('+'): # expands a '+' at the beginning of a rule as @include
-                c_property = '@include ' + c_property[1:]
-                try:
-                    if '(' not in c_property or c_property.index(':') < c_property.index('('):
-                        c_property = c_property.replace(':', '(', 1)
-                        if '(' in c_property: c_property += ')'
-                except ValueError:
-                    pass
-            elif c_property.startswith('='): # expands a '=' at the beginning of a rule as @mixin
-                c_property = '@mixin' + c_property[1:]
-            elif c_property == '@prototype ': # Remove '@prototype '
-                c_property = c_property[11:]
-            ####################################################################
-            if c_property.startswith('@'):
-                code, name = (c_property.split(None, 1)+[''])[:2]
-                code = code.lower()
-                if code == '@warn':
-                    name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
-                    log.warn(dequote(to_str(name)))
-                elif code == '@print':
-                    name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
-                    log.info(dequote(to_str(name)))
-                elif code == '@raw':
-                    name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
-                    log.info(repr(name))
-                elif code == '@debug':
-                    global DEBUG
-                    name = name.strip()
-                    if name.lower() in ('1', 'true', 't', 'yes', 'y', 'on'):
-                        name = 1
-                    elif name.lower() in ('0', 'false', 'f', 'no', 'n', 'off'):
-                        name = 0
-                    DEBUG = name
-                    log.info("Debug mode is %s", 'On' if DEBUG else 'Off')
-                elif code == '@option':
-                    self._settle_options(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
-                elif code == '@import':
-                    self._do_import(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
-                elif code == '@extend':
-                    name = self.apply_vars(name, rule[CONTEXT], rule[OPTIONS], rule)
-                    p_parents.update(p.strip() for p in name.replace(',', '&').split('&'))
-                    p_parents.discard('')
-                elif c_codestr is not None and code in ('@mixin', '@function'):
-                    self._do_functions(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
-                elif code == '@return':
-                    ret = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
-                    rule[OPTIONS]['@return'] = ret
-                    return
-                elif code == '@include':
-                    self._do_include(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
-                elif c_codestr is not None and (code == '@if' or c_property.startswith('@else if ')):
-                    self._do_if(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
-                elif c_codestr is not None and code == '@else':
-                    self._do_else(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
-                elif c_codestr is not None and code == '@for':
-                    self._do_for(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
-                elif c_codestr is not None and code == '@each':
-                    self._do_each(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
-                elif c_codestr is not None and code in ('@variables', '@vars'):
-                    self._get_variables(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr)
-                elif c_codestr is not None and code == '@media':
-                    _media = (media or []) +  [ name ]
-                    rule[CODESTR] = self.construct + ' {' + c_codestr + '}'
-                    self.manage_children(rule, p_selectors, p_parents, p_children, scope, _media)
-                elif c_codestr is None:
-                    rule[PROPERTIES].append((c_property, None))
-                elif scope is None: # needs to have no scope to crawl down the nested rules
-                    self._nest_rules(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr)
-            ####################################################################
-            # Properties
+    def manage_children(self, rule, p_selectors, p_parents, p_children, scope, media, blocks=None):
+        """
+        Manages all properties and blocks in the rule's code (or the given
+        `blocks`, already located in it).
+        """
+        if blocks is None:
+            blocks = self.located_blocks(rule[CODESTR])
+        for c_property, c_codestr in blocks:
+            if self.manage_child(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr):
+                return
+
+    def manage_child(self, rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr):
+        """
+        Manages a single property or block of a rule. Returns True when the
+        rest of the rule should be skipped (after a @return).
+        """
+        # Rules preprocessing...
+        if c_property.startswith('+'): # expands a '+' at the beginning of a rule as @include
+            c_property = '@include ' + c_property[1:]
+            try:
+                if '(' not in c_property or c_property.index(':') < c_property.index('('):
+                    c_property = c_property.replace(':', '(', 1)
+                    if '(' in c_property: c_property += ')'
+            except ValueError:
+                pass
+        elif c_property.startswith('='): # expands a '=' at the beginning of a rule as @mixin
+            c_property = '@mixin' + c_property[1:]
+        elif c_property == '@prototype ': # Remove '@prototype '
+            c_property = c_property[11:]
+        ####################################################################
+        if c_property.startswith('@'):
+            code, name = (c_property.split(None, 1)+[''])[:2]
+            code = code.lower()
+            if code == '@warn':
+                name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
+                log.warn(dequote(to_str(name)))
+            elif code == '@print':
+                name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
+                log.info(dequote(to_str(name)))
+            elif code == '@raw':
+                name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
+                log.info(repr(name))
+            elif code == '@debug':
+                global DEBUG
+                name = name.strip()
+                if name.lower() in ('1', 'true', 't', 'yes', 'y', 'on'):
+                    name = 1
+                elif name.lower() in ('0', 'false', 'f', 'no', 'n', 'off'):
+                    name = 0
+                DEBUG = name
+                log.info("Debug mode is %s", 'On' if DEBUG else 'Off')
+            elif code == '@option':
+                self._settle_options(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
+            elif code == '@import':
+                self._do_import(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
+            elif code == '@extend':
+                name = self.apply_vars(name, rule[CONTEXT], rule[OPTIONS], rule)
+                p_parents.update(p.strip() for p in name.replace(',', '&').split('&'))
+                p_parents.discard('')
+            elif c_codestr is not None and code in ('@mixin', '@function'):
+                self._do_functions(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
+            elif code == '@return':
+                ret = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
+                rule[OPTIONS]['@return'] = ret
+                return True
+            elif code == '@include':
+                self._do_include(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
+            elif c_codestr is not None and (code == '@if' or c_property.startswith('@else if ')):
+                self._do_if(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
+            elif c_codestr is not None and code == '@else':
+                self._do_else(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
+            elif c_codestr is not None and code == '@for':
+                self._do_for(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
+            elif c_codestr is not None and code == '@each':
+                self._do_each(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
+            elif c_codestr is not None and code in ('@variables', '@vars'):
+                self._get_variables(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr)
+            elif c_codestr is not None and code == '@media':
+                _media = (media or []) +  [ name ]
+                rule[CODESTR] = self.construct + ' {' + c_codestr + '}'
+                self.manage_children(rule, p_selectors, p_parents, p_children, scope, _media)
             elif c_codestr is None:
-                self._get_properties(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr)
-            # Nested properties
-            elif c_property.endswith(':'):
-                rule[CODESTR] = c_codestr
-                self.manage_children(rule, p_selectors, p_parents, p_children, (scope or '') + c_property[:-1] + '-', media)
-            ####################################################################
-            # Nested rules
+                rule[PROPERTIES].append((c_property, None))
             elif scope is None: # needs to have no scope to crawl down the nested rules
                 self._nest_rules(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr)
+        ####################################################################
+        # Properties
+        elif c_codestr is None:
+            self._get_properties(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr)
+        # Nested properties
+        elif c_property.endswith(':'):
+            rule[CODESTR] = c_codestr
+            self.manage_children(rule, p_selectors, p_parents, p_children, (scope or '') + c_property[:-1] + '-', media)
+        ####################################################################
+        # Nested rules
+        elif scope is None: # needs to have no scope to crawl down the nested rules
+            self._nest_rules(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr)
 
     @print_timing(10)
     def _settle_options(self, rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name):
@@ -917,10 +1129,11 @@ class Scss(object):
                     if default:
                         default = self.apply_vars(default, rule[CONTEXT], None, rule)
                         defaults[param] = default
-            context = rule[CONTEXT].copy()
-            for p in new_params:
-                context.pop(p, None)
-            mixin = [ list(new_params), defaults, self.apply_vars(c_codestr, context, None, rule) ]
+            # Pre-compile the definition: interpolate the variables it doesn't
+            # get as parameters and locate its blocks, once, so that using it
+            # only needs to bind the arguments:
+            m_codestr = self.apply_vars(c_codestr, _HiddenVars(rule[CONTEXT], new_params), None, rule)
+            mixin = [ list(new_params), defaults, m_codestr, self.located_blocks(m_codestr, True) ]
             if code == '@function':
                 def _call(mixin):
                     def __call(R, *args, **kwargs):
@@ -933,7 +1146,7 @@ class Scss(object):
                         m_vars.update(kwargs)
                         _options = rule[OPTIONS].copy()
                         _rule = [ '', R[SELECTORS], m_codestr, set(), m_vars, _options, '', [], './', False, R[MEDIA] ]
-                        self.manage_children(_rule, p_selectors, p_parents, p_children, (scope or '') + '', R[MEDIA])
+                        self.manage_children(_rule, p_selectors, p_parents, p_children, (scope or '') + '', R[MEDIA], mixin[3])
                         ret = _options.pop('@return', '')
                         return ret
                     return __call
@@ -954,23 +1167,29 @@ class Scss(object):
         """
         Implements @include, for @mixins
         """
-        funct, params, _ = name.partition('(')
-        funct = funct.strip()
-        params = split_params(depar(params + _))
-        new_params = {}
-        num_args = 0
-        for param in params:
-            varname, _, param = param.partition(':')
-            if param:
-                param = param.strip()
-                varname = varname.strip()
-            else:
-                param = varname.strip()
-                varname = num_args
+        try:
+            funct, new_params, num_args = _include_cache[name]
+        except KeyError:
+            funct, params, _ = name.partition('(')
+            funct = funct.strip()
+            params = split_params(depar(params + _))
+            new_params = {}
+            num_args = 0
+            for param in params:
+                varname, _, param = param.partition(':')
                 if param:
-                    num_args += 1
-            if param:
-                new_params[varname] = param
+                    param = param.strip()
+                    varname = varname.strip()
+                else:
+                    param = varname.strip()
+                    varname = num_args
+                    if param:
+                        num_args += 1
+                if param:
+                    new_params[varname] = param
+            if len(_include_cache) >= INCLUDE_CACHE_SIZE:
+                _include_cache.clear()
+            _include_cache[name] = funct, new_params, num_args
         mixin = rule[OPTIONS].get('@mixin ' + funct + ':' + unicode(num_args))
         if not mixin:
             # Fallback to single parmeter:
@@ -997,7 +1216,7 @@ class Scss(object):
             _rule[CODESTR] = m_codestr
             _rule[CONTEXT] = rule[CONTEXT].copy()
             _rule[CONTEXT].update(m_vars)
-            self.manage_children(_rule, p_selectors, p_parents, p_children, scope, media)
+            self.manage_children(_rule, p_selectors, p_parents, p_children, scope, media, mixin[3])
         else:
             log.error("Required mixin not found: %s:%d", funct, num_args)
 
@@ -1013,14 +1232,17 @@ class Scss(object):
             for name in names:
                 name = dequote(name.strip())
                 if '@import ' + name not in rule[OPTIONS]: # If already imported in this scope, skip...
-                    try:
-                        raise KeyError
-                        i_codestr = self._scss_files[name]
-                    except KeyError:
+                    i_codestr = None
+                    import_key = (name, os.path.dirname(rule[PATH]), LOAD_PATHS, os.getcwd())
+                    cached = _import_cache.get(import_key)
+                    if cached is not None:
+                        full_filename, mtime, i_codestr = cached
+                        if _get_mtime(full_filename) != mtime:
+                            i_codestr = None
+                    if i_codestr is None:
                         filename = os.path.basename(name)
                         dirname = os.path.dirname(name)
                         load_paths = []
-                        i_codestr = None
                         for path in [ './' ] + LOAD_PATHS.split(','):
                             for basepath in [ './', os.path.dirname(rule[PATH]) ]:
                                 i_codestr = None
@@ -1051,7 +1273,11 @@ class Scss(object):
                                 break
                         if i_codestr is None:
                             i_codestr = self._do_magic_import(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
-                        i_codestr = self._scss_files[name] = i_codestr and self.load_string(i_codestr)
+                            i_codestr = i_codestr and self.load_string(i_codestr)
+                        else:
+                            i_codestr = self.load_string(i_codestr)
+                            _import_cache[import_key] = (full_filename, _get_mtime(full_filename), i_codestr)
+                        self._scss_files[name] = i_codestr
                     if i_codestr is None:
                         log.warn("File to import not found or unreadable: '%s'\nLoad paths:\n\t%s", filename, "\n\t".join(load_paths))
                     else:
@@ -4355,13 +4581,258 @@ class Calculator(Parser):
 
 ### Grammar ends.
 
+################################################################################
+# Compiled expressions
+
+def _eval_all(nodes):
+    def __eval_all(R):
+        for node in nodes[:-1]:
+            node(R)
+        return nodes[-1](R)
+    return __eval_all
+
+def _unary_op(op, a):
+    def __unary_op(R):
+        return op(a(R))
+    return __unary_op
+
+def _binary_op(op, a, b):
+    def __binary_op(R):
+        # Both operands are always evaluated, just like the Calculator does:
+        _a = a(R)
+        _b = b(R)
+        return op(_a, _b)
+    return __binary_op
+
+def _const_value(cls, token):
+    def __const_value(R):
+        # Values are mutable, so every evaluation gets its own
+        return cls(ParserValue(token))
+    return __const_value
+
+def _list_value(steps):
+    def __list_value(R):
+        v = {}
+        for k, node in steps:
+            v[k] = node(R)
+        return ListValue(ParserValue(v))
+    return __list_value
+
+def _first_or_list(lst):
+    def __first_or_list(R):
+        v = lst(R)
+        return v.first() if len(v) == 1 else v
+    return __first_or_list
+
+_compare_ops = {
+    'LT': operator.lt,
+    'GT': operator.gt,
+    'LE': operator.le,
+    'GE': operator.ge,
+    'EQ': operator.eq,
+    'NE': operator.ne,
+}
+
+class CalculatorCompiler(Calculator):
+    """
+    Parses the same grammar as the Calculator, but instead of evaluating the
+    expression while parsing it, it returns a tree of closures that evaluates
+    it for a given rule. The tree only looks up variables and calls functions,
+    so it can be cached and evaluated many times (see eval_expr).
+    """
+    def goal(self):
+        expr_lst = self.expr_lst()
+        END = self._scan('END')
+        return _first_or_list(expr_lst)
+
+    def expr(self):
+        v = self.and_test()
+        while self._peek(self.expr_rsts) == 'OR':
+            OR = self._scan('OR')
+            v = _binary_op(lambda a, b: a or b, v, self.and_test())
+        return v
+
+    def and_test(self):
+        v = self.not_test()
+        while self._peek(self.and_test_rsts) == 'AND':
+            AND = self._scan('AND')
+            v = _binary_op(lambda a, b: a and b, v, self.not_test())
+        return v
+
+    def not_test(self):
+        _token_ = self._peek(self.not_test_rsts)
+        if _token_ not in self.not_test_chks:
+            return self.comparison()
+        else:# in self.not_test_chks
+            nodes = []
+            while 1:
+                _token_ = self._peek(self.not_test_chks)
+                if _token_ == 'NOT':
+                    NOT = self._scan('NOT')
+                    nodes.append(_unary_op(operator.not_, self.not_test()))
+                else:# == 'INV'
+                    INV = self._scan('INV')
+                    nodes.append(_unary_op(lambda a: _inv('!', a), self.not_test()))
+                if self._peek(self.not_test_rsts_) not in self.not_test_chks: break
+            return _eval_all(nodes) if len(nodes) > 1 else nodes[0]
+
+    def comparison(self):
+        v = self.a_expr()
+        while self._peek(self.comparison_rsts) in self.comparison_chks:
+            _token_ = self._peek(self.comparison_chks)
+            self._scan(_token_)
+            v = _binary_op(_compare_ops[_token_], v, self.a_expr())
+        return v
+
+    def a_expr(self):
+        v = self.m_expr()
+        while self._peek(self.a_expr_rsts) in self.a_expr_chks:
+            _token_ = self._peek(self.a_expr_chks)
+            if _token_ == 'ADD':
+                ADD = self._scan('ADD')
+                v = _binary_op(operator.add, v, self.m_expr())
+            else:# == 'SUB'
+                SUB = self._scan('SUB')
+                v = _binary_op(operator.sub, v, self.m_expr())
+        return v
+
+    def m_expr(self):
+        v = self.u_expr()
+        while self._peek(self.m_expr_rsts) in self.m_expr_chks:
+            _token_ = self._peek(self.m_expr_chks)
+            if _token_ == 'MUL':
+                MUL = self._scan('MUL')
+                v = _binary_op(operator.mul, v, self.u_expr())
+            else:# == 'DIV'
+                DIV = self._scan('DIV')
+                v = _binary_op(operator.div, v, self.u_expr())
+        return v
+
+    def u_expr(self):
+        _token_ = self._peek(self.u_expr_rsts)
+        if _token_ == 'SIGN':
+            SIGN = self._scan('SIGN')
+            return _unary_op(lambda a: _inv('-', a), self.u_expr())
+        elif _token_ == 'ADD':
+            ADD = self._scan('ADD')
+            return self.u_expr()
+        else:# in self.u_expr_chks
+            atom = self.atom()
+            if self._peek(self.u_expr_rsts_) == 'UNITS':
+                UNITS = self._scan('UNITS')
+                return lambda R: call(UNITS, ListValue(ParserValue({ 0: atom(R), 1: UNITS })), R, False)
+            return atom
+
+    def atom(self):
+        _token_ = self._peek(self.u_expr_chks)
+        if _token_ == 'LPAR':
+            LPAR = self._scan('LPAR')
+            expr_lst = self.expr_lst()
+            RPAR = self._scan('RPAR')
+            return _first_or_list(expr_lst)
+        elif _token_ == 'ID':
+            ID = self._scan('ID')
+            return lambda R: ID
+        elif _token_ == 'FNCT':
+            FNCT = self._scan('FNCT')
+            expr_lst = None
+            LPAR = self._scan('LPAR')
+            if self._peek(self.atom_rsts) != 'RPAR':
+                expr_lst = self.expr_lst()
+            RPAR = self._scan('RPAR')
+            if expr_lst is None:
+                return lambda R: call(FNCT, None, R)
+            return lambda R: call(FNCT, expr_lst(R), R)
+        elif _token_ == 'NUM':
+            NUM = self._scan('NUM')
+            return _const_value(NumberValue, NUM)
+        elif _token_ == 'STR':
+            STR = self._scan('STR')
+            return _const_value(StringValue, STR)
+        elif _token_ == 'QSTR':
+            QSTR = self._scan('QSTR')
+            return _const_value(QuotedStringValue, QSTR)
+        elif _token_ == 'BOOL':
+            BOOL = self._scan('BOOL')
+            return _const_value(BooleanValue, BOOL)
+        elif _token_ == 'COLOR':
+            COLOR = self._scan('COLOR')
+            return _const_value(ColorValue, COLOR)
+        else:# == 'VAR'
+            VAR = self._scan('VAR')
+            return lambda R: interpolate(VAR, R)
+
+    def expr_lst(self):
+        # The keys of the resulting list are worked out here, the values are
+        # evaluated (in the same order) by _list_value():
+        keys = {}
+        steps = []
+        n = None
+        if self._peek(self.expr_lst_rsts) == 'VAR':
+            VAR = self._scan('VAR')
+            if self._peek(self.expr_lst_rsts_) == '":"':
+                self._scan('":"')
+                n = VAR
+            else: self._rewind()
+        k = n or 0
+        keys[k] = True
+        steps.append((k, self.expr_slst()))
+        while self._peek(self.expr_lst_rsts__) == 'COMMA':
+            n = None
+            COMMA = self._scan('COMMA')
+            keys['_'] = True
+            steps.append(('_', lambda R, COMMA=COMMA: COMMA))
+            if self._peek(self.expr_lst_rsts) == 'VAR':
+                VAR = self._scan('VAR')
+                if self._peek(self.expr_lst_rsts_) == '":"':
+                    self._scan('":"')
+                    n = VAR
+                else: self._rewind()
+            k = n or len(keys)
+            keys[k] = True
+            steps.append((k, self.expr_slst()))
+        return _list_value(steps)
+
+    def expr_slst(self):
+        nodes = [ self.expr() ]
+        while self._peek(self.expr_slst_rsts) not in self.expr_lst_rsts__:
+            nodes.append(self.expr())
+        if len(nodes) == 1:
+            return nodes[0]
+        return _list_value(list(enumerate(nodes)))
+
+# Process-wide cache of compiled expressions, cleared when it grows past
+# EXPR_CACHE_SIZE (0 disables it):
+EXPR_CACHE_SIZE = 20000
+_expr_cache = {}
+
+def compile_expr(expr):
+    """
+    Returns a function that evaluates `expr` for a given rule. Expressions that
+    can't be parsed return a function that raises the parsing error.
+    """
+    try:
+        return _expr_cache[expr]
+    except KeyError:
+        pass
+    try:
+        P = CalculatorCompiler(CalculatorScanner())
+        P.reset(expr)
+        compiled = P.goal()
+    except Exception, e:
+        def compiled(R, e=e):
+            raise e
+    if EXPR_CACHE_SIZE:
+        if len(_expr_cache) >= EXPR_CACHE_SIZE:
+            _expr_cache.clear()
+        _expr_cache[expr] = compiled
+    return compiled
+
 def eval_expr(expr, rule, raw=False):
     #print >>sys.stderr, '>>',expr,'<<'
     val = None
     try:
-        P = Calculator(CalculatorScanner())
-        P.reset(expr)
-        results = P.goal(rule)
+        results = compile_expr(expr)(rule)
         if raw:
             #print >>sys.stderr, '%%',repr(results),'%%'
             return results
@@ -26,9 +26,114 @@ available_locales = [
     ('fr', u'Français'),
 ]
 
+# Stylesheet imports: levels of @import to follow, most bytes of CSS to fetch per import, seconds to wait for
+# each fetch, most fetches at once, top-level sheets fetched together, and seconds a task works before
+# leaving the rest to the next.
+# `validate` parses imported sheets with cssutils, dropping what it doesn't understand and reformatting the
+# rest, instead of copying them as they are (with their urls made absolute). It's much slower.
+importer = dict(
+    validate = False,
+    max_depth = 4,
+    max_bytes = 800 * 1024,
+    fetch_deadline = 10,
+    concurrent_fetches = 20,
+    batch_size = 50,
+    time_budget = 8 * 60,
+)
+
 # API Keys for url2png.com
+# `fake` serves a placeholder image from this app instead, e.g. for testing locally.
 url2png = dict(
     user = 'USERNAME',
     password = 'PASSWORD',
     bounds = '300x300',
+    fake = debug,
+)
+
+# Preview captures are queued on the 'preview-requests' pull queue and taken up to `batch_size`
+# at a time, fetching concurrently, by a worker that starts `batch_delay` seconds after the first.
+previews = dict(
+    batch_size = 20,
+    batch_delay = 10,
+    lease_seconds = 60,
+)
+
+# Compiled CSS cache: total length (in characters) of the css and logs kept in each instance, and
+# seconds to keep them in memcache. Entries over a tenth of `local_length` are only kept in memcache.
+# `incremental` reuses the compiled output of unchanged top-level blocks on cache misses.
+compile_cache = dict(
+    local_length = 16 * 1024 * 1024,
+    memcache_time = 7 * 24 * 60 * 60,
+    incremental = True,
+)
+
+# Published CSS bundles are written through to memcache when a page is published or its styles
+# change, and expire after `memcache_time` seconds in case some other change was missed. Ones
+# looked up by another form of the page key (an id, or a style key) expire after
+# `alias_memcache_time` seconds. Only one request rebuilds a missing bundle, for at most
+# `rebuild_lock_time` seconds, while the others serve the previous one.
+published_bundle = dict(
+    memcache_time = 24 * 60 * 60,
+    alias_memcache_time = 24 * 60 * 60,
+    rebuild_lock_time = 10,
+)
+
+# Cache-Control lifetimes, in seconds, for published CSS. Preview CSS is always sent with no-cache.
+# `versioned_max_age` is for the content-hashed /css/<page_key>/<version>.css urls, which never change.
+css_cache_control = dict(
+    max_age = 5 * 60,
+    stale_while_revalidate = 24 * 60 * 60,
+    versioned_max_age = 365 * 24 * 60 * 60,
+)
+
+# Redirect /css/<page_key> to the current content-hashed url, so browsers can keep the CSS for good.
+css_versioned_urls = True
+
+# View counts are added up in each instance and written to livecount in one batch after `max_events`
+# views or `max_age` seconds, whichever comes first (checked as views are counted), and on shutdown.
+# Counts buffered in an instance that dies without shutting down are lost; set `enabled` to False
+# to write every view straight through. `keep_on_error` retries a failed flush with the next one
+# instead of dropping its counts.
+count_buffer = dict(
+    enabled = True,
+    max_events = 100,
+    max_age = 30,
+    keep_on_error = True,
+)
+
+# Top referrers are tracked per day in a Space-Saving sketch of at most `capacity` (netloc, page)
+# pairs, merged into memcache with up to `cas_retries` compare-and-set attempts per flush.
+referrer_sketch = dict(
+    capacity = 200,
+    cas_retries = 5,
+)
+
+# User and site totals are kept in this many shards each. Until a total has been reconciled against
+# the datastore once, the stats cron queues a count of it in batches of `reconcile_batch_size` keys.
+sharded_totals = dict(
+    shards = 20,
+    reconcile_batch_size = 1000,
 )
+
+# Editor channels record a heartbeat in memcache on every RPC, but only write it to the datastore
+# every `write_interval` seconds. Channels without one for `stale_after` seconds are dropped.
+channel_heartbeat = dict(
+    write_interval = 5 * 60,
+    stale_after = 60 * 60,
+)
+
+# Rapid editor saves of a style are coalesced: while one request compiles the style, newer saves
+# replace the pending one and the requests they superseded answer with the newest result.
+# `debounce_ms` delays each save to gather more of them. Waiting requests check back every
+# `poll_ms`; a stuck compile's lock is taken over after `lock_time` seconds, and requests that
+# still couldn't take it after `wait` seconds (keep it longer than lock_time) fail with a 503.
+save_coalescing = dict(
+    enabled = True,
+    debounce_ms = 0,
+    poll_ms = 100,
+    wait = 40,
+    lock_time = 30,
+)
+
+# Seconds browsers may keep a page's preview image when asked for by its versioned url.
+preview_max_age = 365 * 24 * 60 * 60
@@ -0,0 +1,55 @@
+"""
+Tests for the app and the changes made to its vendored libraries. Run them
+from the repository root with:
+
+    python -m unittest discover -s tests -t .
+
+The ones that use App Engine services (through AppEngineTestCase) need the
+App Engine SDK on the PYTHONPATH.
+"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from utils import adjust_sys_path
+adjust_sys_path()
+adjust_sys_path('ziplibs')
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass # only AppEngineTestCase needs the SDK
+
+def read_example(name):
+    '''
+    The contents of one of the example stylesheets in app/templates.
+    '''
+    return open(os.path.join(ROOT, 'app', 'templates', name)).read().decode('utf-8')
+
+EXAMPLES = ['examples/blog-html4.css', 'examples/blog-html5.css', 'first_run.css']
+
+class AppEngineTestCase(unittest.TestCase):
+    '''
+    Runs each test against fresh datastore, memcache and task queue stubs,
+    in a request context of the app (for url_for).
+    '''
+    def setUp(self):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+        from app import create_app
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='tghwputty')
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_user_stub()
+        self.context = create_app().test_request_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        self.testbed.deactivate()
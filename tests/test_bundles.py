@@ -0,0 +1,130 @@
+import unittest
+from mock import Mock, patch
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.runtime.apiproxy_errors import RequestTooLargeError
+from app.compiler import gunzip_bytes
+from app.models import Site, Style, StyleRevision, Page, PublishedBundle, CachedBundle
+from tests import AppEngineTestCase
+
+class PublishedBundleTest(AppEngineTestCase):
+    def setUp(self):
+        super(PublishedBundleTest, self).setUp()
+        site = Site(name='Test Site', example=True)
+        site.put()
+        self.style = Style(site=site, name='Test Style')
+        self.style.put()
+        self.rev = StyleRevision(parent=self.style, rev=0)
+        self.rev.update(u'$c: #336699;\n.a { color: $c; }\n.b { .c { margin: 1px; } }')
+        self.style.published_rev = self.rev
+        self.style.put()
+        self.page = Page(site=site, name='Test Page', url='http://example.com/', _styles=[self.style.key()])
+        self.page.put()
+        self.cache_key = PublishedBundle._cache_key(str(self.page.key()))
+
+    def edit(self, raw):
+        self.rev.update(raw)
+        self.page.reload_styles()
+
+    def stored(self):
+        return PublishedBundle.get_by_key_name(str(self.page.key()))
+
+    def assertServes(self, bundle, css):
+        self.assertEqual(bundle.css, css)
+        self.assertEqual(gunzip_bytes(bundle.gzipped), css)
+
+    def test_publish(self):
+        bundle = PublishedBundle.publish(self.page)
+        css = self.page.compressed_css(False).encode('utf-8')
+        self.assertServes(bundle, css)
+        self.assertEqual(bundle.generation, 1)
+        self.assertEqual(bundle.version, bundle.etag[:16])
+        self.assertServes(self.stored(), css)
+        self.assertEqual(self.stored().etag, bundle.etag)
+
+    def test_memcache_holds_no_uncompressed_css(self):
+        bundle = PublishedBundle.publish(self.page)
+        for key in (self.cache_key, self.cache_key + '-stale'):
+            cached = memcache.get(key)
+            self.assertTrue(isinstance(cached, CachedBundle))
+            self.assertFalse('css' in cached.__dict__)
+            self.assertEqual(cached.etag, bundle.etag)
+            self.assertServes(cached, bundle.css)
+        self.assertEqual(PublishedBundle.get_for_page(self.page).etag, bundle.etag)
+
+    def test_load_on_memcache_miss(self):
+        bundle = PublishedBundle.publish(self.page)
+        memcache.flush_all()
+        loaded = PublishedBundle.get_for_page(str(self.page.key()))
+        self.assertEqual(loaded.etag, bundle.etag)
+        self.assertServes(loaded, bundle.css)
+        self.assertEqual(memcache.get(self.cache_key).etag, bundle.etag)
+        self.assertEqual(memcache.get(self.cache_key + '-stale').etag, bundle.etag)
+
+    def test_published_when_first_asked_for(self):
+        bundle = PublishedBundle.get_for_page(self.page)
+        self.assertServes(bundle, self.page.compressed_css(False).encode('utf-8'))
+        self.assertEqual(self.stored().etag, bundle.etag)
+
+    def test_stale_bundle_while_another_request_rebuilds(self):
+        old = PublishedBundle.publish(self.page)
+        self.edit(u'.a { color: red; }')
+        PublishedBundle.publish(self.page)
+        memcache.set(self.cache_key + '-stale', CachedBundle(old))
+        memcache.delete(self.cache_key)
+        memcache.add(self.cache_key + '-lock', 1)
+        self.assertEqual(PublishedBundle.get_for_page(self.page).etag, old.etag)
+
+    def test_republish(self):
+        first = PublishedBundle.publish(self.page)
+        same = PublishedBundle.publish(self.page)
+        self.assertEqual(same.etag, first.etag)
+        self.assertEqual(same.dt_last_modified, first.dt_last_modified)
+        self.assertEqual(same.generation, 2)
+        self.edit(u'.a { color: red; }')
+        changed = PublishedBundle.publish(self.page)
+        self.assertNotEqual(changed.etag, first.etag)
+        self.assertTrue(changed.dt_last_modified >= first.dt_last_modified)
+        self.assertEqual(PublishedBundle.get_for_page(self.page).etag, changed.etag)
+
+    def test_last_modified_moves_on_when_a_style_is_removed(self):
+        other = Style(site=self.page.site, name='Other Style')
+        other.put()
+        rev = StyleRevision(parent=other, rev=0)
+        rev.update(u'.other { color: blue; }')
+        other.published_rev = rev
+        other.put()
+        self.page.styles = [self.style, other]
+        self.page.put()
+        first = PublishedBundle.publish(self.page)
+        # The revision of the style that's left is older than the other's
+        self.page.styles = [self.style]
+        self.page.put()
+        second = PublishedBundle.publish(self.page)
+        self.assertNotEqual(second.etag, first.etag)
+        self.assertTrue(second.dt_last_modified >= first.dt_last_modified)
+
+    def test_too_big_to_store(self):
+        PublishedBundle.publish(self.page)
+        self.edit(u'.a { color: red; }')
+        css = self.page.compressed_css(False).encode('utf-8')
+        with patch.object(PublishedBundle, 'put', Mock(side_effect=RequestTooLargeError())):
+            PublishedBundle.publish(self.page)
+            # The previous bundle is gone, so misses rebuild the new one.
+            self.assertEqual(self.stored(), None)
+            memcache.flush_all()
+            self.assertServes(PublishedBundle.get_for_page(self.page), css)
+
+    def test_other_errors_propagate(self):
+        with patch.object(PublishedBundle, 'put', Mock(side_effect=db.Timeout())):
+            self.assertRaises(db.Timeout, PublishedBundle.publish, self.page)
+
+    def test_discard(self):
+        PublishedBundle.publish(self.page)
+        PublishedBundle.discard(self.page)
+        self.assertEqual(self.stored(), None)
+        self.assertEqual(memcache.get(self.cache_key), None)
+        self.assertEqual(memcache.get(self.cache_key + '-stale'), None)
+
+if __name__ == '__main__':
+    unittest.main()
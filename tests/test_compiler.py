@@ -0,0 +1,79 @@
+import unittest
+import scss
+import settings
+from app import compiler
+from tests import AppEngineTestCase, EXAMPLES, read_example
+
+SHEET = u'''
+@import "compass/css3";
+$base: #336699;
+.box { @include border-radius(4px); color: darken($base, 10%); .inner { margin: 10px / 2; } }
+@media print { .box { display: none; } }
+'''
+
+def _uncached(raw, compress=True):
+    if not compress:
+        raw = '@option compress:no;' + raw
+    return scss.Scss().compile(raw)
+
+class CompileCacheTest(AppEngineTestCase):
+    def setUp(self):
+        super(CompileCacheTest, self).setUp()
+        self.local_length = settings.compile_cache['local_length']
+        self.clear_local()
+
+    def tearDown(self):
+        settings.compile_cache['local_length'] = self.local_length
+        self.clear_local()
+        super(CompileCacheTest, self).tearDown()
+
+    def clear_local(self):
+        compiler._local.clear()
+        compiler._local_length = 0
+
+    def counted(self, func):
+        # How the compile_stats() counters changed while calling func
+        before = compiler.compile_stats()
+        func()
+        after = compiler.compile_stats()
+        return dict((stat, after[stat] - before[stat]) for stat in ('local_hits', 'memcache_hits', 'misses'))
+
+    def test_matches_uncached_compile(self):
+        for raw in [SHEET] + [read_example(name) for name in EXAMPLES]:
+            for compress in (True, False):
+                expected = _uncached(raw, compress)
+                def compile_three_ways():
+                    self.assertEqual(compiler.compile_scss(raw, compress)[0], expected)
+                    self.assertEqual(compiler.compile_scss(raw, compress)[0], expected) # from this instance
+                    self.clear_local()
+                    self.assertEqual(compiler.compile_scss(raw, compress)[0], expected) # from memcache
+                self.assertEqual(self.counted(compile_three_ways), dict(local_hits=1, memcache_hits=1, misses=1))
+
+    def test_options_are_part_of_the_key(self):
+        self.assertEqual(compiler.compile_scss(SHEET, True)[0], _uncached(SHEET, True))
+        self.assertEqual(compiler.compile_scss(SHEET, False)[0], _uncached(SHEET, False))
+
+    def test_stats_are_cached_with_the_css(self):
+        css, log, compile_ms, stats = compiler.compile_scss_with_stats(SHEET)
+        self.assertEqual(stats, compiler.css_stats(css))
+        self.clear_local()
+        self.assertEqual(compiler.compile_scss_with_stats(SHEET), (css, log, compile_ms, stats))
+
+    def test_local_cache_is_bounded_by_length(self):
+        settings.compile_cache['local_length'] = 500
+        for n in range(50):
+            compiler.compile_scss(u'.rule-%d { width: %dpx; }' % (n, n))
+        stats = compiler.compile_stats()
+        self.assertTrue(stats['local_length'] <= 500)
+        self.assertTrue(0 < stats['local_size'] < 50)
+
+    def test_large_entries_are_only_kept_in_memcache(self):
+        settings.compile_cache['local_length'] = 2000
+        raw = u''.join(u'.rule-%d { width: %dpx; }\n' % (n, n) for n in range(100))
+        css = compiler.compile_scss(raw)[0]
+        self.assertEqual(compiler.compile_stats()['local_size'], 0)
+        counts = self.counted(lambda: self.assertEqual(compiler.compile_scss(raw)[0], css))
+        self.assertEqual(counts, dict(local_hits=0, memcache_hits=1, misses=0))
+
+if __name__ == '__main__':
+    unittest.main()
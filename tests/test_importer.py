@@ -0,0 +1,208 @@
+import unittest
+from mock import patch
+import settings
+from app import importer
+
+class _Response(object):
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {'content-type': 'text/css'}
+
+class _RPC(object):
+    def __init__(self, fetches):
+        self.fetches = fetches
+        self.url = None
+
+    def get_result(self):
+        self.fetches.in_flight -= 1
+        sheet = self.fetches.sheets.get(self.url)
+        if isinstance(sheet, Exception):
+            raise sheet
+        if sheet is None:
+            return _Response('', 404)
+        return _Response(sheet)
+
+class _Fetches(object):
+    '''
+    Stands in for async urlfetch, answering from `sheets` (url -> css, or an
+    exception to raise); any other url is a 404.
+    '''
+    def __init__(self, sheets):
+        self.sheets = sheets
+        self.fetched = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+
+    def create_rpc(self, deadline=None):
+        return _RPC(self)
+
+    def make_fetch_call(self, rpc, url):
+        rpc.url = url
+        self.fetched.append(url)
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+
+def _sheets(count):
+    return dict(('http://example.com/%d.css' % n, '.rule-%d { width: %dpx; }\n' % (n, n)) for n in range(count))
+
+class ImportSourcesTest(unittest.TestCase):
+    def setUp(self):
+        self.options = dict(settings.importer)
+
+    def tearDown(self):
+        settings.importer.clear()
+        settings.importer.update(self.options)
+
+    def run_import(self, sheets, sources, deadline=0, size=0):
+        # With the deadline passed, one batch is imported.
+        self.fetches = _Fetches(sheets)
+        with patch.object(importer.urlfetch, 'create_rpc', self.fetches.create_rpc):
+            with patch.object(importer.urlfetch, 'make_fetch_call', self.fetches.make_fetch_call):
+                return importer.import_sources(sources, deadline, size)
+
+    def test_inlines_imports(self):
+        sheets = {
+            'http://example.com/css/main.css': '@import "base.css";\n@import url(print.css) print;\n.main { background: url(../img/bg.png); }',
+            'http://example.com/css/base.css': 'body { margin: 0; }',
+            'http://example.com/css/print.css': '.main { display: none; }',
+        }
+        style, errors, rest, size = self.run_import(sheets, [importer._source('http://example.com/css/main.css')])
+        self.assertEqual(errors, [])
+        self.assertEqual(rest, [])
+        self.assertEqual(size, sum(len(css) for css in sheets.values()))
+        self.assertFalse('@import' in style)
+        self.assertTrue(style.index('body { margin: 0; }') < style.index('/* Imported from http://example.com/css/print.css */\n@media print {\n.main { display: none; }\n}'))
+        self.assertTrue(style.index('@media print {') < style.index('.main { background: url(http://example.com/img/bg.png); }'))
+
+    def test_inline_styles_and_media(self):
+        sheets = {'http://example.com/a.css': '.a { color: red; }'}
+        sources = [
+            importer._source('http://example.com/a.css', 'screen'),
+            importer._source('http://example.com/', None, '@import "a.css";\n.b { color: blue; }'),
+        ]
+        style, errors, rest, size = self.run_import(sheets, sources)
+        self.assertEqual(errors, [])
+        self.assertEqual(self.fetches.fetched, ['http://example.com/a.css'])
+        self.assertTrue(style.index('@media screen {') < style.index('.b { color: blue; }'))
+        self.assertEqual(style.count('.a { color: red; }'), 2)
+
+    def test_import_cycles(self):
+        sheets = {
+            'http://example.com/a.css': '@import "b.css";\n.a { color: red; }',
+            'http://example.com/b.css': '@import "a.css";\n.b { color: blue; }',
+        }
+        style, errors, rest, size = self.run_import(sheets, [importer._source('http://example.com/a.css')])
+        self.assertEqual(sorted(self.fetches.fetched), sorted(sheets))
+        self.assertEqual(style.count('.a { color: red; }'), 1)
+        self.assertEqual(style.count('.b { color: blue; }'), 1)
+
+    def test_failures_only_affect_their_source(self):
+        sheets = {
+            'http://example.com/a.css': '@import "missing.css";\n.a { color: red; }',
+            'http://example.com/broken.css': ValueError('Connection reset'),
+            'http://example.com/c.css': '.c { color: green; }',
+        }
+        sources = [importer._source(url) for url in ('http://example.com/a.css', 'http://example.com/broken.css', 'http://example.com/c.css')]
+        style, errors, rest, size = self.run_import(sheets, sources)
+        self.assertEqual(sorted(errors), ['Error importing http://example.com/broken.css', 'Error importing http://example.com/missing.css'])
+        self.assertTrue('.a { color: red; }' in style)
+        self.assertTrue('.c { color: green; }' in style)
+        self.assertTrue('@import url("http://example.com/missing.css");' in style) # left for the browser
+
+    def test_failing_to_normalize_a_source(self):
+        sheets = _sheets(2)
+        sources = [importer._source(url) for url in sorted(sheets)]
+        def normalize(css, href):
+            if href.endswith('/0.css'):
+                raise ValueError('Bad sheet')
+            return css
+        with patch.object(importer, '_normalize', normalize):
+            style, errors, rest, size = self.run_import(sheets, sources)
+        self.assertEqual(errors, ['Error importing http://example.com/0.css'])
+        self.assertFalse('.rule-0' in style)
+        self.assertTrue('.rule-1' in style)
+
+    def test_max_bytes(self):
+        settings.importer.update(max_bytes=100, concurrent_fetches=2)
+        sheets = _sheets(20)
+        sources = [importer._source(url) for url in sorted(sheets)]
+        style, errors, rest, size = self.run_import(sheets, sources)
+        imported = style.count('/* Imported from')
+        self.assertTrue(0 < imported < 20)
+        self.assertTrue(size <= 100)
+        self.assertTrue(len(self.fetches.fetched) < 20)
+        self.assertEqual(len(errors), 20 - imported)
+        self.assertTrue(all(error.startswith('Skipped ') for error in errors))
+
+    def test_concurrent_fetches(self):
+        settings.importer.update(concurrent_fetches=3)
+        sheets = _sheets(10)
+        style, errors, rest, size = self.run_import(sheets, [importer._source(url) for url in sorted(sheets)])
+        self.assertEqual(len(self.fetches.fetched), 10)
+        self.assertEqual(self.fetches.most_in_flight, 3)
+
+    def test_continuing(self):
+        settings.importer.update(batch_size=2)
+        sheets = _sheets(5)
+        sources = [importer._source(url) for url in sorted(sheets)]
+        style, errors, rest, size = self.run_import(sheets, sources)
+        self.assertEqual(rest, sources[2:])
+        self.assertEqual(style.count('/* Imported from'), 2)
+        more, errors, rest, size = self.run_import(sheets, rest, size=size)
+        self.assertEqual(rest, sources[4:])
+        self.assertEqual(size, sum(len(sheets[source['url']]) for source in sources[:4]))
+
+BASE = 'http://example.com/css/main.css'
+
+class RewriteUrlsTest(unittest.TestCase):
+    def assertRewrites(self, css, expected):
+        self.assertEqual(importer._rewrite_urls(css, BASE), expected)
+
+    def test_relative_urls(self):
+        self.assertRewrites(u'.a { background: url(img/a.png) no-repeat; }', u'.a { background: url(http://example.com/css/img/a.png) no-repeat; }')
+        self.assertRewrites(u'.a { background: url( "../a.png" ); }', u'.a { background: url("http://example.com/a.png"); }')
+        self.assertRewrites(u".a { background: url('/a.png'); }", u".a { background: url('http://example.com/a.png'); }")
+
+    def test_urls_left_alone(self):
+        for css in (u'.a { background: url(http://other.com/a.png); }',
+                u'.a { filter: url(#blur); }',
+                u'.a { background: url(data:image/png;base64,iVBORw0KGgo=); }',
+                u'.a { content: "url(a.png)"; }',
+                u'/* url(a.png) */ .a { color: red; }'):
+            self.assertRewrites(css, css)
+
+    def test_empty_queries(self):
+        self.assertRewrites(u"@font-face { src: url(font.eot?#iefix) format('embedded-opentype'); }", u"@font-face { src: url(http://example.com/css/font.eot?#iefix) format('embedded-opentype'); }")
+        self.assertRewrites(u'@font-face { src: url("font.eot?"); }', u'@font-face { src: url("http://example.com/css/font.eot?"); }')
+        self.assertRewrites(u'.a { background: url(a.png?v=1#x); }', u'.a { background: url(http://example.com/css/a.png?v=1#x); }')
+        css = u'@font-face { src: url(http://other.com/font.eot?#iefix); }'
+        self.assertRewrites(css, css)
+
+    def test_imports(self):
+        self.assertRewrites(u'@import "base.css";\n@import url(print.css) print;', u'@import "http://example.com/css/base.css";\n@import url(http://example.com/css/print.css) print;')
+        self.assertRewrites(u'.a { content: "base.css"; }', u'.a { content: "base.css"; }')
+
+    def test_html_comment_markers(self):
+        self.assertRewrites(u'<!--\n.a { color: red; }\n-->', u'\n.a { color: red; }\n')
+
+    def test_everything_else_is_kept(self):
+        css = u'/* Header */\n.a  >  .b{color:red}\n\n@media print {\n  .c { margin : 0 }\n}\n.d { *zoom: 1; _height: 1px; }\n'
+        self.assertRewrites(css, css)
+
+class HoistImportsTest(unittest.TestCase):
+    def test_hoist(self):
+        css = u'/* @import "commented.css"; */\n.a { color: red; }\n@import url("http://example.com/b.css") print;\n.c { color: blue; }\n'
+        self.assertEqual(importer.hoist_imports(css), u'@import url("http://example.com/b.css") print;\n/* @import "commented.css"; */\n.a { color: red; }\n.c { color: blue; }\n')
+
+    def test_imports_left_for_the_browser(self):
+        # Fetched and not, in a source with media
+        batch = importer._Batch([importer._source(BASE, 'screen')], 0)
+        batch.sheets = {BASE: u'@import "a.css";\n@import "missing.css" print;\n.main { color: red; }', 'http://example.com/css/a.css': u'.a { color: blue; }'}
+        style = importer.hoist_imports(batch.assemble())
+        self.assertTrue(style.startswith(u'@import url("http://example.com/css/missing.css") print;\n'))
+        self.assertEqual(style.count('@import'), 1)
+        self.assertTrue(u'.a { color: blue; }' in style)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import scss
+from tests import EXAMPLES, read_example
+
+class IncrementalCompilationTest(unittest.TestCase):
+    def assertLikeCompile(self, raw):
+        expected = scss.Scss().compile(raw)
+        self.assertEqual(scss.Scss().compile_incremental(raw), expected)
+        self.assertEqual(scss.Scss().compile_incremental(raw), expected) # from the block cache
+
+    def test_examples(self):
+        for name in EXAMPLES:
+            raw = read_example(name)
+            self.assertLikeCompile(raw)
+            self.assertLikeCompile('@option compress:no;' + raw)
+
+    def test_edits(self):
+        raw = read_example(EXAMPLES[0])
+        self.assertLikeCompile(raw)
+        self.assertLikeCompile(raw + u'\n.added { color: red; }')
+        self.assertLikeCompile(raw.replace(u'{', u'{ margin: 1px;', 1))
+        self.assertLikeCompile(u'$base: #123456;\n' + raw)
+
+    def test_variables_before_blocks(self):
+        self.assertLikeCompile(u'$w: 10px;\n.a { width: $w; }\n.b { width: $w * 2; }')
+        self.assertLikeCompile(u'$w: 20px;\n.a { width: $w; }\n.b { width: $w * 2; }')
+        self.assertLikeCompile(u'$w: 10px;\n.a { width: $w; }\n$w: 30px;\n.b { width: $w * 2; }')
+
+    def test_mixins_and_imports(self):
+        self.assertLikeCompile(u'@mixin pad($p) { padding: $p; }\n.a { @include pad(1px); }\n.b { @include pad(2px); }')
+        self.assertLikeCompile(u'@mixin pad($p) { padding: $p * 2; }\n.a { @include pad(1px); }\n.b { @include pad(2px); }')
+        self.assertLikeCompile(u'@import "compass/css3";\n.a { @include border-radius(4px); }\n.b { @include opacity(0.5); }')
+
+    def test_extend(self):
+        self.assertLikeCompile(u'.a { color: red; }\n.b { @extend .a; width: 1px; }')
+
+    def test_extend_from_an_imported_mixin(self):
+        # The @extend is only in blueprint/_interaction.scss
+        self.assertLikeCompile(u'@import "blueprint/interaction";\n.msg { color: red; }\n.warn { @include error(msg); }')
+        self.assertLikeCompile(u'@import "blueprint/interaction";\n@include blueprint-interaction;\n.x { color: blue; }')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from google.appengine.api import memcache
+from werkzeug.exceptions import HTTPException
+import settings
+from app import saves
+from app.models import Site, Style, StyleRevision, Page, PublishedBundle
+from tests import AppEngineTestCase
+
+class SaveStyleTest(AppEngineTestCase):
+    def setUp(self):
+        super(SaveStyleTest, self).setUp()
+        self.options = dict(settings.save_coalescing)
+        site = Site(name='Test Site', example=True)
+        site.put()
+        self.style = Style(site=site, name='Test Style')
+        self.style.put()
+        rev = StyleRevision(parent=self.style, rev=0)
+        rev.update(u'.a { color: red; }')
+        self.style.published_rev = rev
+        self.style.put()
+        self.page = Page(site=site, name='Test Page', url='http://example.com/', _styles=[self.style.key()])
+        self.page.put()
+
+    def tearDown(self):
+        settings.save_coalescing.clear()
+        settings.save_coalescing.update(self.options)
+        super(SaveStyleTest, self).tearDown()
+
+    def fresh(self):
+        return Style.get(self.style.key())
+
+    def test_save(self):
+        result = saves.save_style(self.page, self.style, u'.a { color: blue; }')
+        style = self.fresh()
+        self.assertEqual(style.preview_rev.raw, u'.a { color: blue; }')
+        self.assertEqual(style.published_rev.raw, u'.a { color: red; }')
+        self.page.reload_styles()
+        self.assertEqual(result['css'], self.page.compressed_css(True))
+        self.assertTrue('#00f' in result['css'])
+
+    def test_publish(self):
+        result = saves.save_style(self.page, self.style, u'.a { color: blue; }', publish=True)
+        style = self.fresh()
+        self.assertEqual(style.preview_rev, None)
+        self.assertEqual(style.published_rev.raw, u'.a { color: blue; }')
+        self.assertEqual(PublishedBundle.get_for_page(self.page).css, result['css'].encode('utf-8'))
+
+    def test_unlocked_writes_are_never_made(self):
+        settings.save_coalescing.update(wait=0.2, poll_ms=10)
+        memcache.add(saves._key(self.style, 'lock'), 1, time=60)
+        self.assertRaises(HTTPException, saves.save_style, self.page, self.style, u'.a { color: blue; }')
+        self.assertEqual(self.fresh().preview_rev, None)
+
+    def test_memcache_only_gets_the_outcome(self):
+        saves.save_style(self.page, self.style, u'.a { color: blue; }')
+        seq, log, published = memcache.get(saves._key(self.style, 'outcome'))
+        self.assertEqual(seq, memcache.get(saves._key(self.style, 'seq')))
+        self.assertFalse(published)
+
+    def test_superseded_save_answers_with_the_newer_one(self):
+        newer = saves.save_style(self.page, self.style, u'.a { color: blue; }')
+        # As if our save started before that one finished
+        seq, log, published = memcache.get(saves._key(self.style, 'outcome'))
+        memcache.set(saves._key(self.style, 'seq'), seq - 5)
+        result = saves.save_style(self.page, self.style, u'.a { color: green; }')
+        self.assertEqual(result, newer)
+        self.assertEqual(self.fresh().preview_rev.raw, u'.a { color: blue; }')
+
+    def test_older_outcomes_dont_replace_newer_ones(self):
+        saves._finished(self.style, 10, {'css': u'', 'log': 'newer'}, False)
+        saves._finished(self.style, 9, {'css': u'', 'log': 'older'}, False)
+        self.assertEqual(memcache.get(saves._key(self.style, 'outcome')), (10, 'newer', False))
+
+    def test_without_coalescing(self):
+        settings.save_coalescing.update(enabled=False)
+        result = saves.save_style(self.page, self.style, u'.a { color: blue; }')
+        self.assertEqual(self.fresh().preview_rev.raw, u'.a { color: blue; }')
+        self.assertTrue('#00f' in result['css'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for the Tokenizer's first char dispatch (see
+Tokenizer._dispatch_productions).
+
+It tokenizes the Blueprint and Compass CSS bundled with pyScss (compiled
+unminified) and the site's own stylesheets, with and without dispatch,
+checking that both give the same tokens, and times tokenizing them both
+ways, as whole sheets and as the partial ones cssutils tokenizes while
+parsing.
+
+Usage: python tools/cssutils_benchmark.py [rounds]
+"""
+
+import os
+import sys
+import glob
+import time
+import logging
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'libs'))
+from cssutils import tokenize2
+
+FRAMEWORKS = '''
+@option compress:no;
+@import "compass/css3";
+@import "compass/utilities";
+@import "compass/typography";
+@import "blueprint";
+@include blueprint;
+@include blueprint-typography;
+.box { @include border-radius(4px); @include box-shadow(1px 1px 2px #333); @include clearfix; }
+'''
+
+def _sheets():
+    import scss
+    sheets = [('blueprint+compass', scss.Scss().compile(FRAMEWORKS))]
+    for path in sorted(glob.glob(os.path.join(ROOT, 'static', 'css', '*', '*.css'))):
+        sheets.append((os.path.basename(path), open(path).read().decode('utf-8')))
+    return sheets
+
+def _time(func, rounds):
+    best = None
+    for i in range(rounds):
+        t = time.time()
+        func()
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    return best
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    logging.disable(logging.CRITICAL)
+    sheets = _sheets()
+
+    tokens = 0
+    for name, css in sheets:
+        linear = list(tokenize2.Tokenizer(dispatch=False).tokenize(css, fullsheet=True))
+        dispatched = list(tokenize2.Tokenizer(dispatch=True).tokenize(css, fullsheet=True))
+        if linear != dispatched:
+            print 'Tokens differ for %s!' % name
+            sys.exit(1)
+        tokens += len(linear)
+
+    # Declarations are tokenized again on their own when a sheet is parsed.
+    declarations = []
+    for name, css in sheets:
+        declarations.extend(css[start + 1:css.find('}', start)] for start in range(len(css)) if css[start] == '{')
+
+    def tokenize_sheets(dispatch):
+        tokenizer = tokenize2.Tokenizer(dispatch=dispatch)
+        for name, css in sheets:
+            for token in tokenizer.tokenize(css, fullsheet=True):
+                pass
+    def tokenize_declarations(dispatch):
+        tokenizer = tokenize2.Tokenizer(dispatch=dispatch)
+        for css in declarations:
+            for token in tokenizer.tokenize(css):
+                pass
+
+    results = []
+    for label, dispatch in (('linear', False), ('dispatch', True)):
+        results.append((label, _time(lambda: tokenize_sheets(dispatch), rounds), _time(lambda: tokenize_declarations(dispatch), rounds)))
+
+    print '%d sheets, %d KB, %d tokens (identical both ways), best of %d rounds' % (len(sheets), sum(len(css) for name, css in sheets) / 1024, tokens, rounds)
+    print '%-10s %12s %12s' % ('', 'sheets', 'declarations')
+    for label, whole, partial in results:
+        print '%-10s %11.1fms %11.1fms' % (label, whole * 1000, partial * 1000)
+    print '%-10s %11.1fx %11.1fx' % ('speedup', results[0][1] / results[1][1], results[0][2] / results[1][2])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for the compiled expression cache (see eval_expr) over the
+bundled Compass and Blueprint frameworks.
+
+It records every expression evaluated while compiling a sheet that imports
+and uses the frameworks, then times evaluating them all with and without the
+cache, and finally times whole compilations both ways.
+
+Usage: python tools/scss_benchmark.py [rounds]
+"""
+
+import os
+import sys
+import time
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'libs'))
+import scss
+
+SHEET = '''
+@import "compass/css3";
+@import "compass/utilities";
+@import "compass/typography";
+@import "blueprint";
+$base: #336699;
+$gutter: 10px;
+@include blueprint-typography;
+.box {
+    @include border-radius(4px);
+    @include box-shadow(1px 1px 2px darken($base, 20%));
+    @include linear-gradient(color-stops(lighten($base, 30%), $base));
+    @include opacity(0.8);
+    @include clearfix;
+    padding: $gutter / 2 $gutter * 2;
+}
+.col { @include column(5); margin-right: $gutter + 5px; }
+.last { @include column(3, true); }
+.text { @include ellipsis; color: mix($base, #fff, 25%); }
+'''
+
+def _record_expressions():
+    expressions = []
+    eval_expr = scss.eval_expr
+    def recording_eval_expr(expr, rule, raw=False):
+        expressions.append((expr, list(rule), raw))
+        return eval_expr(expr, rule, raw)
+    scss.eval_expr = recording_eval_expr
+    try:
+        scss.Scss().compile(SHEET)
+    finally:
+        scss.eval_expr = eval_expr
+    return expressions
+
+def _time(func, rounds):
+    best = None
+    for i in range(rounds):
+        t = time.time()
+        func()
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    return best
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    logging.disable(logging.CRITICAL)
+    cache_size = scss.EXPR_CACHE_SIZE
+
+    expressions = _record_expressions()
+    def evaluate_all():
+        for expr, rule, raw in expressions:
+            scss.eval_expr(expr, rule, raw)
+    def compile_sheet():
+        scss.Scss().compile(SHEET)
+
+    results = []
+    for label, size in (('uncached', 0), ('cached', cache_size)):
+        scss.EXPR_CACHE_SIZE = size
+        scss._expr_cache.clear()
+        if size:
+            evaluate_all() # warm up the cache
+        results.append((label, _time(evaluate_all, rounds), _time(compile_sheet, rounds)))
+    scss.EXPR_CACHE_SIZE = cache_size
+
+    print '%d expressions evaluated per compile (%d distinct), best of %d rounds' % (len(expressions), len(set(e[0] for e in expressions)), rounds)
+    print '%-10s %12s %12s' % ('', 'eval_expr', 'compile')
+    for label, evaluating, compiling in results:
+        print '%-10s %11.1fms %11.1fms' % (label, evaluating * 1000, compiling * 1000)
+    print '%-10s %11.1fx %11.1fx' % ('speedup', results[0][1] / results[1][1], results[0][2] / results[1][2])
+
+if __name__ == '__main__':
+    main()